@@ -1,9 +1,67 @@
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
 from django.db import models
+from django.db.models import Exists, OuterRef, Q
 
 from kpc.models import Certificate, Licensee
 
 
+class Roles(object):
+    """
+    Groups, review permission and licensee memberships of a single user
+
+    Resolved with one query and memoized on the user instance,
+    which lives for the duration of a request.
+    """
+    CACHE_ATTR = '_kpc_roles'
+
+    def __init__(self, groups, can_review_certificates, licensee_ids, active_licensee_ids):
+        self.groups = groups
+        self.can_review_certificates = can_review_certificates
+        self.licensee_ids = licensee_ids
+        self.active_licensee_ids = active_licensee_ids
+
+    @classmethod
+    def for_user(cls, user):
+        """Memoized roles of the given user"""
+        roles = getattr(user, cls.CACHE_ATTR, None)
+        if roles is None:
+            roles = cls.load(user)
+            setattr(user, cls.CACHE_ATTR, roles)
+        return roles
+
+    @classmethod
+    def clear(cls, user):
+        """Discard memoized roles after group or licensee membership changes"""
+        user.__dict__.pop(cls.CACHE_ATTR, None)
+
+    @classmethod
+    def load(cls, user):
+        review_perm = Permission.objects.filter(
+            Q(user=OuterRef('pk')) | Q(group__user=OuterRef('pk')),
+            content_type__app_label='accounts', codename='can_review_certificates')
+        rows = get_user_model().objects.filter(pk=user.pk).annotate(
+            has_review_perm=Exists(review_perm)).values_list(
+            'groups__name', 'profile__licensees__id', 'profile__licensees__is_active',
+            'has_review_perm')
+
+        groups, licensee_ids, active_licensee_ids = set(), set(), set()
+        has_review_perm = False
+        for group, licensee_id, licensee_active, has_review_perm in rows:
+            if group:
+                groups.add(group)
+            if licensee_id:
+                licensee_ids.add(licensee_id)
+                if licensee_active:
+                    active_licensee_ids.add(licensee_id)
+
+        # Mirror ModelBackend.has_perm: inactive users have no permissions
+        can_review = user.is_active and (user.is_superuser or has_review_perm)
+        return cls(frozenset(groups), can_review,
+                   frozenset(licensee_ids), frozenset(active_licensee_ids))
+
+
 class Profile(models.Model):
     """Store additional user information"""
     user = models.OneToOneField(
@@ -25,11 +83,15 @@ class Profile(models.Model):
         """User's fullname or username"""
         return self.user.get_full_name() or self.user.get_username()
 
+    @property
+    def roles(self):
+        return Roles.for_user(self.user)
+
     def get_licensees(self):
         """List of licensees to which this user has access"""
         if self.user.is_superuser or self.is_auditor:
             return Licensee.objects.all()
-        return self.licensees.filter(is_active=True)
+        return Licensee.objects.filter(id__in=self.roles.active_licensee_ids)
 
     def get_address_book_url(self):
         """URL to display as address book nav link"""
@@ -40,7 +102,16 @@ class Profile(models.Model):
 
     def _is_group_member(self, group):
         """Check if user is member of specified group"""
-        return self.user.groups.filter(name=group).exists()
+        return group in self.roles.groups
+
+    def is_licensee_contact(self, licensee_id, active_only=False):
+        """User is a contact of the specified licensee"""
+        if active_only:
+            return licensee_id in self.roles.active_licensee_ids
+        return licensee_id in self.roles.licensee_ids
+
+    def can_access_all_certificates(self):
+        return self.roles.can_review_certificates or self.is_auditor
 
     @property
     def is_auditor(self):
@@ -56,7 +127,7 @@ class Profile(models.Model):
 
     def certificates(self):
         """Certificates which this user may access"""
-        if self.user.has_perm('accounts.can_review_certificates') or self.is_auditor:
+        if self.can_access_all_certificates():
             return Certificate.objects.all()
         else:
-            return Certificate.objects.filter(licensee__in=self.get_licensees())
+            return Certificate.objects.filter(licensee__in=self.roles.active_licensee_ids)
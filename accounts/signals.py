@@ -3,10 +3,10 @@ import logging
 from django.contrib.auth import get_user_model
 from django.contrib.auth.signals import (user_logged_in, user_logged_out,
                                          user_login_failed)
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_save
 from django.dispatch import receiver
 
-from .models import Profile
+from .models import Profile, Roles
 
 User = get_user_model()
 
@@ -19,6 +19,18 @@ def update_user_profile(sender, instance, created, **kwargs):
     instance.profile.save()
 
 
+@receiver(m2m_changed, sender=User.groups.through, dispatch_uid='clear_roles_on_groups')
+def clear_roles_on_groups(sender, instance, action, reverse, **kwargs):
+    if action.startswith('post_') and not reverse:
+        Roles.clear(instance)
+
+
+@receiver(m2m_changed, sender=Profile.licensees.through, dispatch_uid='clear_roles_on_licensees')
+def clear_roles_on_licensees(sender, instance, action, reverse, **kwargs):
+    if action.startswith('post_') and not reverse:
+        Roles.clear(instance.user)
+
+
 @receiver(user_logged_in, sender=User, dispatch_uid='successful_login')
 def successful_login(sender, request, user, **kwargs):
     logger.info(f'Successful login event for {user.username}.')
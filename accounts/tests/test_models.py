@@ -81,3 +81,24 @@ class ProfileTests(TestCase):
         licensee_b = mommy.make('Licensee')
         user.profile.licensees.add(licensee_b)
         self.assertIsNone(user.profile.get_address_book_url())
+
+    def test_roles_resolved_once(self):
+        """Role checks share a single query for the lifetime of the user instance"""
+        licensee = mommy.make('Licensee')
+        user = mommy.make(User)
+        user.profile.licensees.add(licensee)
+        user.groups.add(Group.objects.get(name='Reviewer'))
+        with self.assertNumQueries(1):
+            self.assertTrue(user.profile.is_reviewer)
+            self.assertFalse(user.profile.is_auditor)
+            self.assertFalse(user.profile.can_edit_certs())
+            self.assertTrue(licensee.user_can_access(user))
+            user.profile.certificates()
+            user.profile.get_licensees()
+
+    def test_roles_cleared_on_group_change(self):
+        """Memoized roles reflect group membership changes"""
+        user = mommy.make(User)
+        self.assertFalse(user.profile.is_auditor)
+        user.groups.add(Group.objects.get(name='Auditor'))
+        self.assertTrue(user.profile.is_auditor)
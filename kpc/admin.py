@@ -7,7 +7,8 @@ from solo.admin import SingletonModelAdmin
 from accounts.models import Profile
 
 from .models import (Certificate, CertificateConfig, HSCode, Licensee,
-                     PortOfExport, VoidReason, KpcAddress, Receipt, EditRequest)
+                     PortOfExport, VoidReason, KpcAddress, Receipt, EditRequest,
+                     QueuedEmail)
 
 
 class LicenseeAdminForm(forms.ModelForm):
@@ -89,10 +90,19 @@ class CertificateAdmin(SimpleHistoryAdmin):
     form = CertificateAdminForm
     change_form_template = "admin/cert-change.html"
     list_display = ('display_name', 'status',
-                    'last_modified', 'licensee', 'assignor',)
+                    'last_modified', 'licensee', 'assignor', 'has_pending_edit')
     list_filter = ('status', 'licensee',)
+    list_select_related = ('licensee', 'assignor')
     search_fields = ('number',)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_edit_state()
+
+    def has_pending_edit(self, obj):
+        return obj.pending_edit is not None
+    has_pending_edit.boolean = True
+    has_pending_edit.short_description = 'Pending edit'
+
 
 @admin.register(PortOfExport)
 class PortOfExportAdmin(SimpleHistoryAdmin):
@@ -125,6 +135,13 @@ class EditRequestAdmin(admin.ModelAdmin):
         return [f.name for f in self.model._meta.fields]
 
 
+@admin.register(QueuedEmail)
+class QueuedEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'created', 'status', 'attempts', 'next_attempt', 'sent')
+    list_filter = ('status', 'created')
+    readonly_fields = ('subject', 'body', 'html', 'to', 'attempts', 'last_error', 'created', 'sent')
+
+
 admin.site.register(HSCode, KpcAdmin)
 admin.site.register(VoidReason, KpcAdmin)
 admin.site.register(KpcAddress, admin.ModelAdmin)
@@ -9,6 +9,8 @@ class KpcConfig(AppConfig):
     name = 'kpc'
 
     def ready(self):
+        # Setup signals
+        import kpc.signals # noqa
         self.irs_docs = self._get_irs_docs()
 
     def _get_irs_docs(self):
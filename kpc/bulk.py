@@ -0,0 +1,179 @@
+import datetime
+from itertools import islice
+
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .models import Certificate, NumberAllocator
+from .utils import number_ranges_q
+
+# Certificates built or read and copied at a time by bulk operations
+BULK_BATCH_SIZE = 5000
+
+
+def _copy_value(value):
+    """Represent a prepared database value in PostgreSQL's CSV COPY format"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, str):
+        # Quoted so that empty strings are not read as NULL
+        return '"' + value.replace('"', '""') + '"'
+    return str(value)
+
+
+class CopyStream(object):
+    """File-like object producing CSV lines for COPY ... FROM STDIN on demand"""
+
+    def __init__(self, rows):
+        self.lines = (','.join(_copy_value(value) for value in row) + '\n' for row in rows)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        for line in self.lines:
+            self.buffer += line
+            if 0 <= size <= len(self.buffer):
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def copy_rows(table, columns, rows):
+    """Stream rows into table using COPY ... FROM STDIN"""
+    quote = connection.ops.quote_name
+    sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        quote(table), ', '.join(quote(column) for column in columns))
+    with connection.cursor() as cursor, connection.wrap_database_errors:
+        cursor.copy_expert(sql, CopyStream(rows))
+
+
+def allocate_ids(model, count):
+    """Reserve primary key values from the model's sequence"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                       [model._meta.db_table, model._meta.pk.column, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def copy_instances(model, instances, history_user=None):
+    """
+    COPY unsaved model instances into their table
+
+    Primary keys are reserved from the sequence when not already set,
+    models tracked by simple_history also receive a '+' (created)
+    historical record for each instance, attributed to history_user.
+    """
+    if not instances:
+        return
+    missing_pk = [obj for obj in instances if obj.pk is None]
+    for obj, pk in zip(missing_pk, allocate_ids(model, len(missing_pk))):
+        obj.pk = pk
+
+    fields = model._meta.concrete_fields
+    copy_rows(model._meta.db_table, [field.column for field in fields],
+              ([field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields]
+               for obj in instances))
+
+    if hasattr(model, 'history'):
+        copy_history(model.history.model, instances, history_user)
+
+
+def copy_history(history_model, instances, history_user=None, history_type='+'):
+    """COPY a historical record of each instance, by default recording its creation"""
+    history_values = {'history_date': timezone.now(), 'history_type': history_type,
+                      'history_user_id': history_user.pk if history_user else None,
+                      'history_change_reason': None}
+    fields = [field for field in history_model._meta.concrete_fields
+              if field.attname != 'history_id']
+
+    def value(obj, field):
+        if field.attname in history_values:
+            return history_values[field.attname]
+        return field.get_db_prep_save(getattr(obj, field.attname), connection)
+
+    copy_rows(history_model._meta.db_table, [field.column for field in fields],
+              ([value(obj, field) for field in fields] for obj in instances))
+
+
+def reset_sequence(model):
+    """Move the primary key sequence past explicitly inserted ids"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT setval(pg_get_serial_sequence(%s, %s), '
+                       'COALESCE(MAX({}), 1)) FROM {}'.format(
+                           connection.ops.quote_name(model._meta.pk.column),
+                           connection.ops.quote_name(model._meta.db_table)),
+                       [model._meta.db_table, model._meta.pk.column])
+
+
+def register_certificates(ranges, history_user=None, batch_size=BULK_BATCH_SIZE, **values):
+    """
+    Create certificates numbered by inclusive (low, high) ranges, in one transaction
+
+    Conflicts are found with range predicates rather than lists of numbers,
+    certificates and their history are then COPYed in batches. Raises
+    IntegrityError if any number is already registered.
+    Returns the number of certificates created.
+    """
+    count = 0
+    with transaction.atomic():
+        if Certificate.objects.filter(number_ranges_q(ranges)).exists():
+            raise IntegrityError('Certificate numbers already registered')
+        numbers = (number for low, high in ranges for number in range(low, high + 1))
+        while True:
+            batch = [Certificate(number=number, **values) for number in islice(numbers, batch_size)]
+            if not batch:
+                break
+            copy_instances(Certificate, batch, history_user=history_user)
+            count += len(batch)
+        # Move the series past this range once the COPY is done, holding
+        # the allocator's row lock only for the rest of the transaction
+        NumberAllocator.reserve(NumberAllocator.CERTIFICATE, 0,
+                                floor=max(high for low, high in ranges) + 1)
+    return count
+
+
+def transition_certificates(queryset, from_status, to_status, date_field, date, history_user=None):
+    """
+    Move certificates in queryset from one status to the next with set-based UPDATEs
+
+    Rows are locked and must all still be in from_status, otherwise
+    nothing is changed and None is returned. A '~' (changed) historical
+    record is written for each certificate. Returns the number updated.
+    """
+    with transaction.atomic():
+        ids = list(queryset.select_for_update(of=('self',)).values_list('id', flat=True))
+        updated = Certificate.objects.filter(id__in=ids, status=from_status).update(
+            status=to_status, last_modified=datetime.datetime.now(), **{date_field: date})
+        if updated != len(ids):
+            transaction.set_rollback(True)
+            return None
+        copy_changed_history(ids, history_user)
+    return updated
+
+
+def void_certificates(queryset, notes, history_user=None):
+    """
+    Void the certificates in queryset which are not already void with one UPDATE
+
+    A '~' (changed) historical record is written for each certificate
+    voided. Returns the number voided.
+    """
+    with transaction.atomic():
+        ids = list(queryset.select_for_update(of=('self',)).filter(void=False).values_list('id', flat=True))
+        updated = Certificate.objects.filter(id__in=ids).update(
+            status=Certificate.VOID, void=True, notes=notes, date_voided=datetime.date.today(),
+            last_modified=datetime.datetime.now())
+        copy_changed_history(ids, history_user)
+    return updated
+
+
+def copy_changed_history(ids, history_user=None):
+    """COPY a '~' (changed) historical record of each certificate id, in batches"""
+    for start in range(0, len(ids), BULK_BATCH_SIZE):
+        certificates = list(Certificate.objects.filter(id__in=ids[start:start + BULK_BATCH_SIZE]))
+        copy_history(Certificate.history.model, certificates, history_user, history_type='~')
@@ -1,4 +1,12 @@
+import hashlib
+import uuid
+
 from django import forms
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db.models import Q
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django_filters import (DateFromToRangeFilter, FilterSet,
                             ModelChoiceFilter, MultipleChoiceFilter,
                             RangeFilter, CharFilter)
@@ -16,10 +24,68 @@ class CheckboxSelectMultiple(forms.CheckboxSelectMultiple):
     template_name = 'uswds/checkbox_input.html'
 
 
+# Party and address fields searched by the free text filter, each has a trigram index
+TEXT_SEARCH_FIELDS = ('exporter', 'exporter_address', 'consignee', 'consignee_address')
+
+
+def text_search(queryset, value):
+    """Certificates with value in any party or address field"""
+    match = Q()
+    for field in TEXT_SEARCH_FIELDS:
+        match |= Q(**{f'{field}__icontains': value})
+    return queryset.filter(match)
+
+
 def licensees(request):
     return request.user.profile.get_licensees()
 
 
+FILTER_CACHE_VERSION_KEY = 'kpc:certificate-filters:version'
+
+
+def filter_cache_version():
+    """Version stamp shared by all workers, changed whenever filter choices may have changed"""
+    shared = caches[settings.CERTIFICATE_CONFIG_VERSION_CACHE]
+    version = shared.get(FILTER_CACHE_VERSION_KEY)
+    if version is None:
+        shared.add(FILTER_CACHE_VERSION_KEY, uuid.uuid4().hex)
+        version = shared.get(FILTER_CACHE_VERSION_KEY)
+    return version
+
+
+def invalidate_filter_cache():
+    caches[settings.CERTIFICATE_CONFIG_VERSION_CACHE].set(FILTER_CACHE_VERSION_KEY, uuid.uuid4().hex)
+
+
+def filter_cache_key(user, *parts):
+    """Cache key for the current choices visible to user's set of licensees"""
+    profile = user.profile
+    if user.is_superuser or profile.is_auditor:
+        scope = 'all'
+    else:
+        scope = '.'.join(str(id) for id in sorted(profile.roles.active_licensee_ids))
+    return ':'.join(['kpc:certificate-filters', filter_cache_version(), scope, *parts])
+
+
+def filter_panel(request):
+    """
+    Rendered certificate list filter panel
+
+    Cached per licensee set and query string until a licensee, HS code,
+    port of export or the configuration is saved.
+    """
+    query = hashlib.md5(request.GET.urlencode().encode()).hexdigest()
+    key = filter_cache_key(request.user, 'panel', query)
+    html = cache.get(key)
+    if html is None:
+        filters = CertificateFilter(request.GET, request=request,
+                                    queryset=Certificate.objects.none())
+        filters.use_cached_choices()
+        html = render_to_string('certificate/filters.html', {'filters': filters}, request=request)
+        cache.set(key, html, settings.CERTIFICATE_FILTER_CACHE_TIMEOUT)
+    return mark_safe(html)  # nosec
+
+
 class CertificateFilter(FilterSet):
     DATE_ATTR = {'type': 'date', 'placeholder': 'mm/dd/yyyy'}
 
@@ -38,16 +104,20 @@ class CertificateFilter(FilterSet):
     date_of_shipment = DateFromToRangeFilter(widget=RangeWidget(attrs=DATE_ATTR))
     date_voided = DateFromToRangeFilter(widget=RangeWidget(attrs=DATE_ATTR))
 
+    text = CharFilter(method='filter_text', label='Exporter, consignee or address contains')
     aes = CharFilter(lookup_expr='icontains')
     exporter = CharFilter(lookup_expr='icontains')
     exporter_address = CharFilter(lookup_expr='icontains')
     consignee = CharFilter(lookup_expr='icontains')
     consignee_address = CharFilter(lookup_expr='icontains')
 
+    # Fields with choices loaded from the database or configuration
+    CACHED_CHOICE_FIELDS = ('licensee__name', 'country_of_origin', 'harmonized_code', 'port_of_export')
+
     class Meta:
         model = Certificate
 
-        default_fields = ['status', 'aes', 'date_of_issue']
+        default_fields = ['text', 'status', 'aes', 'date_of_issue']
         extra_fields = ['licensee__name', 'country_of_origin',
                         'harmonized_code', 'port_of_export',
                         'shipped_value',
@@ -59,6 +129,21 @@ class CertificateFilter(FilterSet):
 
         fields = default_fields + extra_fields
 
+    def filter_text(self, queryset, name, value):
+        return text_search(queryset, value)
+
+    def use_cached_choices(self):
+        """Render choice fields from cached choice lists rather than querying for them"""
+        key = filter_cache_key(self.request.user, 'choices')
+        choices = cache.get(key)
+        if choices is None:
+            choices = {name: [(value, str(label)) for value, label in self.form.fields[name].choices]
+                       for name in self.CACHED_CHOICE_FIELDS}
+            cache.set(key, choices, settings.CERTIFICATE_FILTER_CACHE_TIMEOUT)
+        # Only the widget is given the list, the fields still validate against their queryset or choices
+        for name, field_choices in choices.items():
+            self.form.fields[name].widget.choices = field_choices
+
     @property
     def default_fields(self):
         return [field for field in self.form if field.name in self.Meta.default_fields]
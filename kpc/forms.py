@@ -1,14 +1,21 @@
 import datetime
 import logging
+import re
+from functools import lru_cache
 
 from django import forms
 from django.contrib.auth import get_user_model
 from django.core.validators import RegexValidator
+from django.urls import reverse
+from django.utils.translation import get_language
 from django_countries import Countries
-from django_countries.fields import CountryField
+from django_countries.fields import Country, CountryField
 
-from .models import (Certificate, CertificateConfig, EditRequest, KpcAddress,
-                     Licensee, Receipt)
+from .models import (Certificate, CertificateConfig, CertificateStatistic,
+                     EditRequest, KpcAddress, Licensee, Receipt)
+from .bulk import transition_certificates, void_certificates
+from .utils import (collapse_numbers, collapse_ranges, number_list_ranges,
+                    number_ranges_q)
 
 LOGGER = logging.getLogger(__name__)
 
@@ -41,6 +48,33 @@ class KPCountries(Countries):
         return [country.code for country in countries]
 
 
+class KPCountryMatcher(object):
+    """Find KP country names within addresses using a single compiled expression"""
+
+    def __init__(self, codes):
+        self.countries = {str(country.name).lower(): country
+                          for country in (Country(code=code) for code in codes)}
+        # Longest names first so that e.g. 'Nigeria' is preferred over 'Niger'
+        names = sorted(self.countries, key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(name) for name in names)) if names else None
+
+    def match(self, address):
+        """First KP country named in address, None if there is none"""
+        found = self.pattern.search(address.lower()) if self.pattern else None
+        return self.countries[found.group()] if found else None
+
+    @classmethod
+    def for_config(cls):
+        """Matcher for the KP countries (all countries if none are configured), rebuilt only when they change"""
+        codes = tuple(country.code for country in KPCountries() if country.code)
+        return _kp_country_matcher(codes, get_language())
+
+
+@lru_cache(maxsize=16)
+def _kp_country_matcher(codes, language):
+    return KPCountryMatcher(codes)
+
+
 class EditRequestReviewForm(forms.ModelForm):
     approve = forms.BooleanField(required=False)
     reject = forms.BooleanField(required=False)
@@ -97,7 +131,7 @@ class BaseCertificateForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         """
         All fields are required
-        Populate address books
+        Link address books
         Set selectable countries
         """
         super().__init__(*args, **kwargs)
@@ -105,20 +139,20 @@ class BaseCertificateForm(forms.ModelForm):
         self.date_expiry_invalid = f'Date of Expiry must be {self.expiry_days} days after Date of Issue (expected %s)'
         self.fields['date_of_expiry'].label = f"Date of Expiry ({self.expiry_days} days from date issued)"
         self.fields['country_of_origin'] = CountryField(countries=KPCountries).formfield()
-        addresses = self.instance.licensee.addresses.all() if self.instance.licensee else None
-        self.fields['addresses'] = forms.ModelChoiceField(required=False, queryset=addresses)
+        # Address book entries are loaded on demand from this URL
+        self.address_book_url = reverse('licensee-addresses', args=[self.instance.licensee_id]) \
+            if self.instance.licensee_id else None
         for field in self.fields:
-            if field != 'addresses':
-                self.fields[field].required = True
+            self.fields[field].required = True
 
     def find_kp_country(self, address):
         """
-        Check for a KP country name in address
+        Check for a KP country name in address, returning the country found
         """
-        countries = [country.name.lower() for country in KPCountries()]
-        address = address.lower()
-        if not any(country in address for country in countries):
+        country = KPCountryMatcher.for_config().match(address)
+        if country is None:
             raise forms.ValidationError(self.COUNTRY_MISSING)
+        return country
 
     def clean_exporter_address(self):
         address = self.cleaned_data.get('exporter_address')
@@ -269,14 +303,16 @@ class CertificateRegisterForm(forms.Form):
                 raise forms.ValidationError(
                     "Certificate 'To' value must be greater than or equal to 'From' value.")
 
-        requested_certs = self.get_cert_list()
         """duplicate certs requested"""
-        if len(requested_certs) != len(set(requested_certs)):
-            raise forms.ValidationError(
-                f"At least two requested certificates were requested with the same ID value, duplicate certificate IDs are not allowed.")
+        if self.method == self.LIST and cert_list:
+            requested_list = self._parse_cert_list()
+            if len(requested_list) != len(set(requested_list)):
+                raise forms.ValidationError(
+                    f"At least two requested certificates were requested with the same ID value, duplicate certificate IDs are not allowed.")
 
         """payment amount matches expected value"""
-        requested_cert_count = len(requested_certs)
+        requested_ranges = self.get_cert_ranges()
+        requested_cert_count = sum(high - low + 1 for low, high in requested_ranges)
         expected_payment = requested_cert_count * self.price
         if payment_amount != expected_payment:
             raise forms.ValidationError(
@@ -284,23 +320,30 @@ class CertificateRegisterForm(forms.Form):
 
         # Check for existence of requested certificates
         existing = Certificate.objects.filter(
-            number__in=requested_certs).exists()
+            number_ranges_q(requested_ranges)).exists()
         if existing:
             raise forms.ValidationError(
                 f"""At least one of the requested certificates already exists in the database.
                     The next available certificate number is: {Certificate.next_available_number()}""")
 
-    def get_cert_list(self):
-        """return list of certificates to generate"""
-        certs = []
-        cert_list = self.cleaned_data.get('cert_list')
+    def _parse_cert_list(self):
+        return [int(cert_number) for cert_number in self.cleaned_data['cert_list'].split(',')]
+
+    def get_cert_ranges(self):
+        """return inclusive (low, high) ranges of certificates to generate"""
         start = self.cleaned_data.get('cert_from')
         end = self.cleaned_data.get('cert_to')
         if self.method == self.SEQUENTIAL and start and end:
-            certs = [i for i in range(start, end+1)]
-        elif self.method == self.LIST and cert_list:
-            certs = [int(cert_number) for cert_number in cert_list.split(',')]
-        return certs
+            return [(start, end)]
+        elif self.method == self.LIST and self.cleaned_data.get('cert_list'):
+            return collapse_numbers(self._parse_cert_list())
+        return []
+
+    def get_cert_list(self):
+        """return list of certificates to generate"""
+        if self.method == self.LIST and self.cleaned_data.get('cert_list'):
+            return self._parse_cert_list()
+        return [number for low, high in self.get_cert_ranges() for number in range(low, high + 1)]
 
     def save(self, commit=False):
         """Generate receipt for this transaction"""
@@ -369,6 +412,111 @@ class StatusUpdateForm(forms.ModelForm):
         return self.instance
 
 
+class BulkCertificateForm(forms.Form):
+    """
+    Select certificates by number, or by the certificate search
+    the user arrived from, to be changed together
+    """
+    MAX_LISTED = 20
+
+    numbers = forms.CharField(required=False, label='Certificate numbers',
+                              widget=forms.Textarea(attrs={'rows': 4}),
+                              help_text='Numbers (US1234) or ranges (US1000-US2000), separated by commas or new lines.')
+
+    INVALID_NUMBERS = 'Certificate numbers must be numbers or ranges of numbers separated by commas or new lines.'
+    NO_CERTIFICATES = 'No certificates selected, please enter certificate numbers.'
+    NOT_FOUND = '%s of the requested certificates were not found.'
+
+    def __init__(self, *args, certificates, filtered=None, **kwargs):
+        """
+        certificates are those the user may change, filtered is a search
+        among them which is used when no numbers are entered
+        """
+        super().__init__(*args, **kwargs)
+        self.certificates = certificates
+        self.filtered = filtered
+
+    def clean(self):
+        cleaned_data = super().clean()
+        numbers = cleaned_data.get('numbers')
+        if numbers:
+            ranges = number_list_ranges(numbers)
+            if ranges is None:
+                raise forms.ValidationError(self.INVALID_NUMBERS)
+            selected = self.certificates.filter(number_ranges_q(ranges))
+            missing = sum(high - low + 1 for low, high in collapse_ranges(ranges)) - selected.count()
+            if missing:
+                raise forms.ValidationError(self.NOT_FOUND % missing)
+        elif self.filtered is not None:
+            selected = self.filtered
+        else:
+            raise forms.ValidationError(self.NO_CERTIFICATES)
+        if not selected.exists():
+            raise forms.ValidationError(self.NO_CERTIFICATES)
+        self.selected = selected
+        return cleaned_data
+
+    def _reject(self, invalid, message):
+        """Raise message listing invalid certificates, if there are any"""
+        numbers = list(invalid.order_by('number').values_list('number', flat=True)[:self.MAX_LISTED + 1])
+        if numbers:
+            listed = ', '.join(f'US{number}' for number in numbers[:self.MAX_LISTED])
+            if len(numbers) > self.MAX_LISTED:
+                listed += ' and more'
+            raise forms.ValidationError(message % listed)
+
+
+class BulkStatusUpdateForm(BulkCertificateForm):
+    """Mark many certificates Shipped or Delivered on the same date"""
+    NEXT_STATUSES = ((Certificate.SHIPPED, 'Shipped'), (Certificate.DELIVERED, 'Delivered'))
+    # next status: (required current status, date it must not precede, date field set)
+    TRANSITIONS = {Certificate.SHIPPED: (Certificate.PREPARED, 'date_of_issue', 'date_of_shipment'),
+                   Certificate.DELIVERED: (Certificate.SHIPPED, 'date_of_shipment', 'date_of_delivery')}
+
+    next_status = forms.TypedChoiceField(choices=NEXT_STATUSES, coerce=int, label='New status')
+    date = forms.DateField(widget=forms.DateInput(attrs=DATE_ATTRS))
+
+    UNEXPECTED_STATUS = 'Only %s certificates which have not been voided can be marked %s: %s'
+    SHIPPED_DATE = 'The Shipped date must be on or after the date of issue of: %s'
+    DELIVERY_DATE = 'The Delivered date must be on or after the date of shipment of: %s'
+    CHANGED = 'Certificates were modified while they were being updated, please try again.'
+    SUCCESS_MSG = '%s certificates have been marked %s.'
+
+    def clean(self):
+        """Every selected certificate must be able to move to the new status on the date"""
+        cleaned_data = super().clean()
+        new_status = cleaned_data.get('next_status')
+        date = cleaned_data.get('date')
+
+        if new_status and date:
+            status, prior_date_field, _ = self.TRANSITIONS[new_status]
+            self._reject(self.selected.exclude(status=status, void=False),
+                         self.UNEXPECTED_STATUS % (Certificate.get_label_for_status(status),
+                                                   Certificate.get_label_for_status(new_status), '%s'))
+            self._reject(self.selected.filter(**{f'{prior_date_field}__gt': date}),
+                         self.SHIPPED_DATE if new_status == Certificate.SHIPPED else self.DELIVERY_DATE)
+        return cleaned_data
+
+    def save(self, user):
+        """Apply the new status, returning the number of certificates updated or None if they changed"""
+        new_status = self.cleaned_data['next_status']
+        status, _, date_field = self.TRANSITIONS[new_status]
+        count = transition_certificates(self.selected, status, new_status, date_field,
+                                        self.cleaned_data['date'], history_user=user)
+        if count is not None:
+            LOGGER.info(f'{count} certificates status updated to: '
+                        f'{Certificate.get_label_for_status(new_status)}')
+        return count
+
+
+def void_reason_choices():
+    choices = [('', '---------')]
+    choices += [(reason.value, reason.value)
+                for reason in Certificate.get_void_reasons()]
+    choices += [(VoidForm.OTHER_CHOICE, VoidForm.OTHER_CHOICE)]
+    return choices
+
+
 class VoidForm(forms.ModelForm):
     OTHER_CHOICE = 'Other'
     void = forms.BooleanField(help_text="I wish to void this certificate.")
@@ -383,12 +531,8 @@ class VoidForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         """Set void reason choices"""
-        choices = [('', '---------')]
-        choices += [(reason.value, reason.value)
-                    for reason in Certificate.get_void_reasons()]
-        choices += [('Other', 'Other')]
         super().__init__(*args, **kwargs)
-        self.fields['reason'].choices = choices
+        self.fields['reason'].choices = void_reason_choices()
 
     def clean(self):
         reason = self.cleaned_data.get('reason')
@@ -409,6 +553,33 @@ class VoidForm(forms.ModelForm):
         return cert
 
 
+class BulkVoidForm(BulkCertificateForm):
+    """Void many certificates for the same reason"""
+    void = forms.BooleanField(help_text="I wish to void these certificates.")
+    reason = forms.ChoiceField(choices=[])
+    notes = forms.CharField(widget=forms.Textarea(), required=False)
+
+    SUCCESS_MSG = '%s certificates have been voided.'
+    ALREADY_VOID = '%s selected certificates had already been voided.'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['reason'].choices = void_reason_choices()
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('reason') == VoidForm.OTHER_CHOICE and not cleaned_data.get('notes'):
+            self.add_error('notes', VoidForm.REASON_REQUIRED)
+        return cleaned_data
+
+    def save(self, user):
+        """Void the selected certificates, returning the number voided"""
+        count = void_certificates(self.selected, self.cleaned_data['notes'] or self.cleaned_data['reason'],
+                                  history_user=user)
+        LOGGER.info(f'{count} certificates voided')
+        return count
+
+
 class KpcAddressForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
@@ -422,3 +593,27 @@ class KpcAddressForm(forms.ModelForm):
     class Meta:
         model = KpcAddress
         fields = ('name', 'address', 'country')
+
+
+class StatisticsForm(forms.Form):
+    """Grouping and filters for certificate statistics"""
+    MONTH_FORMATS = ['%Y-%m']
+    MONTH_ATTRS = {'type': 'month', 'placeholder': 'yyyy-mm'}
+
+    group_by = forms.MultipleChoiceField(
+        choices=[(dimension, dimension.title()) for dimension in CertificateStatistic.DIMENSIONS],
+        initial=['status'], required=False,
+        widget=forms.CheckboxSelectMultiple(attrs={'class': 'usa-unstyled-list'}))
+    licensee = forms.ModelChoiceField(queryset=Licensee.objects.all(), required=False)
+    status = forms.TypedChoiceField(choices=[('', '---------')] + list(Certificate.STATUS_CHOICES),
+                                    coerce=int, empty_value=None, required=False)
+    month_from = forms.DateField(input_formats=MONTH_FORMATS, required=False,
+                                 widget=forms.DateInput(attrs=MONTH_ATTRS))
+    month_to = forms.DateField(input_formats=MONTH_FORMATS, required=False,
+                               widget=forms.DateInput(attrs=MONTH_ATTRS))
+
+    def statistics(self):
+        """Statistics for valid form data"""
+        filters = dict(self.cleaned_data)
+        group_by = filters.pop('group_by') or self.fields['group_by'].initial
+        return list(CertificateStatistic.summarize(group_by, **filters))
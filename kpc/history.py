@@ -0,0 +1,125 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import models, transaction
+from django.utils import timezone
+from simple_history.models import HistoricalRecords
+
+# Historical records inserted per statement when the buffer is flushed
+HISTORY_BATCH_SIZE = 1000
+
+HISTORY_FIELDS = ('history_id', 'history_date', 'history_type', 'history_user_id',
+                  'history_change_reason')
+
+_local = threading.local()
+
+
+def historical_record(history_model, instance, history_type, history_user=None,
+                      history_date=None, history_change_reason=None):
+    """Unsaved historical record of instance's current values"""
+    attrs = {field.attname: getattr(instance, field.attname)
+             for field in history_model._meta.concrete_fields
+             if field.attname not in HISTORY_FIELDS}
+    return history_model(history_date=history_date or timezone.now(), history_type=history_type,
+                         history_user=history_user, history_change_reason=history_change_reason,
+                         **attrs)
+
+
+def _buffer():
+    return getattr(_local, 'buffer', None)
+
+
+def _hold(records):
+    """
+    Add records to the buffer for as long as the savepoint they were made in stands
+
+    Each group registers a no-op on_commit callback, which Django discards
+    when any savepoint enclosing its registration is rolled back, whether
+    opened by buffered_history or a plain transaction.atomic().
+    """
+    def held():
+        pass
+    transaction.on_commit(held)
+    _buffer().append((held, records))
+
+
+def flush_history():
+    """Insert buffered historical records with one bulk INSERT per history model"""
+    buffer = _buffer()
+    if not buffer:
+        return
+    standing = {func for sids, func in transaction.get_connection().run_on_commit}
+    by_model = defaultdict(list)
+    for held, records in buffer:
+        if held in standing:
+            for record in records:
+                by_model[type(record)].append(record)
+    del buffer[:]
+    for history_model, records in by_model.items():
+        history_model.objects.bulk_create(records, batch_size=HISTORY_BATCH_SIZE)
+
+
+@contextmanager
+def buffered_history():
+    """
+    Run a block atomically, holding back its historical records
+    and inserting them together just before the block commits
+
+    Nested blocks share the outermost buffer, records made inside
+    any savepoint which is rolled back are discarded with it.
+    """
+    if _buffer() is not None:
+        with transaction.atomic():
+            yield
+        return
+
+    _local.buffer = []
+    try:
+        with transaction.atomic():
+            yield
+            flush_history()
+    finally:
+        _local.buffer = None
+
+
+def record_history(instances, history_type='~', history_user=None):
+    """
+    Record history of instances saved without signals, e.g. by bulk_create or update
+
+    Records join the buffer when inside buffered_history, otherwise
+    they are inserted immediately.
+    """
+    if not instances:
+        return
+    history_model = type(instances[0]).history.model
+    history_date = timezone.now()
+    records = [historical_record(history_model, instance, history_type, history_user, history_date)
+               for instance in instances]
+    if _buffer() is not None:
+        _hold(records)
+    else:
+        history_model.objects.bulk_create(records, batch_size=HISTORY_BATCH_SIZE)
+
+
+class IndexedHistoricalRecords(HistoricalRecords):
+    """HistoricalRecords indexed for point in time lookups, e.g. history.as_of(date)"""
+
+    def get_meta_options(self, model):
+        meta_fields = super().get_meta_options(model)
+        meta_fields['indexes'] = [models.Index(fields=[model._meta.pk.attname, 'history_date'])]
+        return meta_fields
+
+
+class BufferedHistoricalRecords(IndexedHistoricalRecords):
+    """HistoricalRecords which join the buffer when saved inside buffered_history"""
+
+    def create_historical_record(self, instance, history_type):
+        if _buffer() is None:
+            return super().create_historical_record(instance, history_type)
+        manager = getattr(instance, self.manager_name)
+        _hold([historical_record(
+            manager.model, instance, history_type,
+            history_user=self.get_history_user(instance),
+            history_date=getattr(instance, '_history_date', None),
+            history_change_reason=getattr(instance, 'changeReason', None))])
@@ -1,7 +1,15 @@
 
+from functools import lru_cache
+from itertools import groupby
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
+from django.core.mail import get_connection
+from django.db import transaction
+from django.template import Context, Engine, engines
+from django.utils import timezone
+
+from .models import CertificateConfig, EditRequest, QueuedEmail
 
 
 User = get_user_model()
@@ -16,32 +24,130 @@ def edit_request_email_context(request, edit_request):
             }
 
 
+@lru_cache(maxsize=None)
+def mail_engine():
+    """
+    Template engine for notifications
+
+    Mail templates, and those they extend or include, are compiled on first
+    use and reused for the life of the process.
+    """
+    engine = engines['django'].engine
+    return Engine(dirs=engine.dirs, libraries=engine.libraries, autoescape=engine.autoescape,
+                  loaders=[('django.template.loaders.cached.Loader', [
+                      'django.template.loaders.filesystem.Loader',
+                      'django.template.loaders.app_directories.Loader'])])
+
+
 def _build_email(context, template_name):
-    subject = render_to_string(f"mail/{template_name}_subject.txt", context)
-    text = render_to_string(f"mail/{template_name}.txt", context)
-    html = render_to_string(f"mail/{template_name}.html", context)
-    return subject, text, html
+    """Render subject, text and html parts of a mail template"""
+    engine = mail_engine()
+    return tuple(engine.get_template(f"mail/{template_name}{suffix}").render(Context(context))
+                 for suffix in ('_subject.txt', '.txt', '.html'))
 
 
 def get_reviewer_emails():
     """Return list of Reviewer user's email addresses"""
-    users = User.objects.filter(is_active=True, groups__name='Reviewer')
-    return [user.email for user in users]
+    return list(User.objects.filter(is_active=True, groups__name='Reviewer')
+                .values_list('email', flat=True))
+
+
+def queue_email(subject, text, html, to, separately=False):
+    """
+    Queue a message for delivery by the send_queued_email command
+
+    With separately, each recipient is sent their own copy rather than
+    a single message addressed to all of them. Returns the queued messages.
+    """
+    recipients = [[address] for address in to] if separately else [to]
+    return QueuedEmail.objects.bulk_create(
+        QueuedEmail(subject=subject, body=text, html=html, to=addresses) for addresses in recipients)
+
+
+def send_queued_email(batch_size=None):
+    """
+    Deliver a batch of due queued messages over a single connection
+
+    Rows are locked with SKIP LOCKED so that several workers can drain
+    the queue concurrently. Returns the number of messages sent and failed.
+    """
+    batch_size = batch_size or settings.EMAIL_QUEUE_BATCH_SIZE
+    sent = failed = 0
+    with transaction.atomic():
+        batch = list(QueuedEmail.objects.select_for_update(skip_locked=True)
+                     .filter(status=QueuedEmail.PENDING, next_attempt__lte=timezone.now())
+                     .order_by('next_attempt')[:batch_size])
+        if not batch:
+            return sent, failed
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            for email in batch:
+                email.retry_later(e)
+                email.save()
+            return sent, len(batch)
+        try:
+            for email in batch:
+                try:
+                    email.as_message(connection).send()
+                except Exception as e:
+                    email.retry_later(e)
+                    failed += 1
+                else:
+                    email.status = QueuedEmail.SENT
+                    email.sent = timezone.now()
+                    sent += 1
+                email.save()
+        finally:
+            connection.close()
+    return sent, failed
 
 
 def notify_reviewers(request, edit_request):
-    """Notify reviewers upon submission of a new EditRequest"""
+    """Notify reviewers upon submission of a new EditRequest, unless they receive digests"""
+    if CertificateConfig.get_solo().reviewer_digest:
+        return
     context = edit_request_email_context(request, edit_request)
     subject, text, html = _build_email(context, 'edit_request_submitted')
-    msg = EmailMultiAlternatives(subject=subject, to=get_reviewer_emails(), body=text)
-    msg.attach_alternative(html, "text/html")
-    msg.send()
+    queue_email(subject, text, html, get_reviewer_emails(), separately=True)
 
 
 def notify_requester_of_completed_review(request, edit_request):
     context = edit_request_email_context(request, edit_request)
     subject, text, html = _build_email(context, 'edit_request_reviewed')
-    msg = EmailMultiAlternatives(
-        subject=subject, to=[edit_request.contact.email], body=text)
-    msg.attach_alternative(html, "text/html")
-    msg.send()
+    queue_email(subject, text, html, [edit_request.contact.email])
+
+
+def queue_reviewer_digest(base_url=None):
+    """
+    Queue each reviewer a summary of pending edit requests not yet
+    included in a digest, grouped by licensee
+
+    Requests are locked with SKIP LOCKED and marked digested in the same
+    transaction, so each is included exactly once whenever it commits.
+    Returns the number of pending edit requests included.
+    """
+    base_url = (base_url or settings.SITE_URL).rstrip('/')
+    config = CertificateConfig.get_solo()
+    with transaction.atomic():
+        edit_requests = list(EditRequest.objects.select_for_update(skip_locked=True, of=('self',))
+                             .filter(status=EditRequest.PENDING, digested_at__isnull=True)
+                             .select_related('certificate__licensee', 'contact__profile')
+                             .order_by('certificate__licensee__name', 'certificate__licensee_id',
+                                       'date_requested'))
+
+        if edit_requests:
+            context = {'licensees': [(licensee, list(group)) for licensee, group in
+                                     groupby(edit_requests, key=lambda e: e.certificate.licensee)],
+                       'count': len(edit_requests),
+                       'base_url': base_url,
+                       'home_url': f'{base_url}/'}
+            subject, text, html = _build_email(context, 'edit_request_digest')
+            queue_email(subject, text, html, get_reviewer_emails(), separately=True)
+
+        digested_at = timezone.now()
+        EditRequest.objects.filter(pk__in=[e.pk for e in edit_requests]).update(digested_at=digested_at)
+        CertificateConfig.objects.filter(pk=config.pk).update(last_reviewer_digest=digested_at)
+        transaction.on_commit(CertificateConfig.invalidate_cache)
+    return len(edit_requests)
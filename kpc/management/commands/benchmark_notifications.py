@@ -0,0 +1,84 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.template.loader import render_to_string
+
+from kpc.mail import _build_email, get_reviewer_emails
+from kpc.models import Certificate, EditRequest
+
+User = get_user_model()
+
+LOCMEM_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+
+class Command(BaseCommand):
+    help = ('Time composing and sending edit request notifications, per message versus '
+            'compiled templates over a single connection. Runs in a transaction which '
+            'is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', dest='count', type=int, default=1000)
+        parser.add_argument('--reviewers', dest='reviewers', type=int, default=5)
+        parser.add_argument('--backend', dest='backend', default=LOCMEM_BACKEND,
+                            help='Email backend messages are sent through')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            reviewers = Group.objects.get_or_create(name='Reviewer')[0]
+            for i in range(options['reviewers']):
+                user = User.objects.create(username=f'benchmark-reviewer-{i}',
+                                           email=f'reviewer{i}@example.com')
+                user.groups.add(reviewers)
+            number = (Certificate.objects.aggregate(Max('number'))['number__max'] or 0) + 1
+            certificate = Certificate.objects.create(number=number, consignee='Consignee')
+            contact = User.objects.create(username='benchmark-contact', email='contact@example.com')
+            edit_request = EditRequest.objects.create(certificate=certificate, contact=contact,
+                                                      consignee='Benchmark Consignee')
+            context = {'edit_request': edit_request,
+                       'cert_url': f'https://example.com{edit_request.certificate.get_absolute_url()}',
+                       'home_url': 'https://example.com/',
+                       'review_url': f'https://example.com{edit_request.get_absolute_url()}'}
+
+            self.stdout.write(f"Sending {options['count']} notifications to "
+                              f"{options['reviewers']} reviewers each")
+            per_message = self.measure(self.send_per_message, context, options)
+            self.stdout.write(f'  render_to_string, connection per message: {per_message:.2f} s')
+            composed = self.measure(self.send_composed, context, options)
+            self.stdout.write(f'  compiled templates, single connection: {composed:.2f} s')
+            self.stdout.write(self.style.SUCCESS(f'  speedup: {per_message / composed:.1f}x'))
+
+            transaction.set_rollback(True)
+
+    def measure(self, send, context, options):
+        started = time.perf_counter()
+        send(context, options['count'], options['backend'])
+        return time.perf_counter() - started
+
+    def send_per_message(self, context, count, backend):
+        """Each notification renders from scratch and opens its own connection"""
+        for _ in range(count):
+            parts = [render_to_string(f'mail/edit_request_submitted{suffix}', context)
+                     for suffix in ('_subject.txt', '.txt', '.html')]
+            to = [user.email for user in User.objects.filter(is_active=True,
+                                                             groups__name='Reviewer')]
+            self.message(*parts, to, get_connection(backend)).send()
+
+    def send_composed(self, context, count, backend):
+        """Notifications rendered from compiled templates, one message per recipient"""
+        messages = []
+        for _ in range(count):
+            subject, text, html = _build_email(context, 'edit_request_submitted')
+            messages.extend(self.message(subject, text, html, [address])
+                            for address in get_reviewer_emails())
+        with get_connection(backend) as connection:
+            connection.send_messages(messages)
+
+    def message(self, subject, text, html, to, connection=None):
+        msg = EmailMultiAlternatives(subject=subject, body=text, to=to, connection=connection)
+        msg.attach_alternative(html, "text/html")
+        return msg
@@ -0,0 +1,49 @@
+import time
+from datetime import date
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from kpc.models import Certificate, HSCode
+from kpc.utils import CertificatePreview
+
+
+class Command(BaseCommand):
+    help = 'Measure certificate PDF previews rendered per second'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', dest='seconds', type=float, default=5)
+
+    def handle(self, *args, **options):
+        certificate = sample_certificate()
+        seconds = options['seconds']
+
+        uncached = self.measure(certificate, seconds, clear_cache=True)
+        self.stdout.write(f'Uncached base page: {uncached:.1f} previews/second')
+
+        cached = self.measure(certificate, seconds, clear_cache=False)
+        self.stdout.write(f'Cached base page: {cached:.1f} previews/second')
+
+        self.stdout.write(self.style.SUCCESS(f'Speedup: {cached / uncached:.2f}x'))
+
+    def measure(self, certificate, seconds, clear_cache):
+        """Render previews for the given duration, return previews per second"""
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            if clear_cache:
+                CertificatePreview.clear_cache()
+            CertificatePreview(certificate).make_preview()
+            count += 1
+        return count / (time.perf_counter() - start)
+
+
+def sample_certificate():
+    """Unsaved certificate with every printed field populated"""
+    return Certificate(number=123456, country_of_origin='AQ', aes='X12345678901234',
+                       date_of_issue=date(2018, 1, 1), date_of_expiry=date(2018, 3, 2),
+                       shipped_value=Decimal('1000.00'), exporter='Exporter',
+                       exporter_address='123 Street\nCity\nAntarctica',
+                       number_of_parcels=1, consignee='Consignee',
+                       consignee_address='456 Street\nCity\nAntarctica',
+                       carat_weight=Decimal('1.50'), harmonized_code=HSCode(value='7102.10'))
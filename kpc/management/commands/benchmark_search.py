@@ -0,0 +1,71 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max
+
+from kpc.filters import TEXT_SEARCH_FIELDS, text_search
+from kpc.models import Certificate
+
+# Synthetic certificates, text columns contain a repeating vocabulary so
+# searches match a realistic fraction of rows
+SYNTHETIC_CERTIFICATES = """
+INSERT INTO kpc_certificate (number, aes, country_of_origin, exporter, exporter_address,
+                             consignee, consignee_address, status, last_modified,
+                             payment_method, void, notes, attested)
+SELECT %(start)s + g,
+       'X' || lpad(g::text, 14, '0'),
+       'BW',
+       'Exporter ' || md5(g::text),
+       (g %% 9000) || ' ' || (ARRAY['Main', 'Canal', 'Diamond', 'Market'])[g %% 4 + 1] || ' Street',
+       (ARRAY['Antwerp', 'Mumbai', 'Dubai', 'Tel Aviv', 'Hong Kong'])[g %% 5 + 1] || ' Trading ' || (g %% 5000),
+       md5((g * 7)::text) || ' Avenue',
+       0, now(), '', false, '', false
+FROM generate_series(1, %(rows)s) AS g
+"""
+
+
+class Command(BaseCommand):
+    help = ('Time certificate text searches on a synthetic table, with and without '
+            'trigram indexes. Runs in a transaction which is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', dest='rows', type=int, default=1000000)
+        parser.add_argument('--repeat', dest='repeat', type=int, default=3)
+        parser.add_argument('--term', dest='terms', action='append',
+                            help='Search term, may be repeated')
+
+    def handle(self, *args, **options):
+        terms = options['terms'] or ['Trading 4217', 'Diamond', 'f00d']
+        with transaction.atomic():
+            start = Certificate.objects.aggregate(Max('number'))['number__max'] or 0
+            self.stdout.write(f"Inserting {options['rows']} synthetic certificates...")
+            with connection.cursor() as cursor:
+                cursor.execute(SYNTHETIC_CERTIFICATES, {'start': start, 'rows': options['rows']})
+                cursor.execute('ANALYZE kpc_certificate')
+
+            for term in terms:
+                qs = text_search(Certificate.objects.all(), term)
+                matches = qs.count()
+                indexed = self.measure(qs, options['repeat'])
+                sequential = self.measure(qs, options['repeat'], use_indexes=False)
+                self.stdout.write(f"'{term}' across {', '.join(TEXT_SEARCH_FIELDS)}: {matches} matches")
+                self.stdout.write(f'  sequential scan: {sequential * 1000:.1f} ms')
+                self.stdout.write(f'  trigram indexes: {indexed * 1000:.1f} ms')
+                self.stdout.write(self.style.SUCCESS(f'  speedup: {sequential / indexed:.1f}x'))
+
+            transaction.set_rollback(True)
+
+    def measure(self, qs, repeat, use_indexes=True):
+        """Best of `repeat` counts of the queryset, in seconds"""
+        setting = 'on' if use_indexes else 'off'
+        with connection.cursor() as cursor:
+            cursor.execute(f'SET LOCAL enable_bitmapscan = {setting}')
+            cursor.execute(f'SET LOCAL enable_indexscan = {setting}')
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            qs.count()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
@@ -1,6 +1,10 @@
 import csv
-import io
+import json
+import multiprocessing
+import os
 import re
+import time
+from collections import deque
 from datetime import datetime
 from decimal import Decimal, InvalidOperation
 
@@ -8,9 +12,12 @@ import pytz
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand
+from django.db import connection
 from django_countries import countries
 from django_countries.fields import Country
 
+from kpc.bulk import copy_instances
+from kpc.history import buffered_history, record_history
 from kpc.models import Certificate, Licensee, PortOfExport
 
 EXPECTED_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
@@ -25,6 +32,14 @@ STATUS_MAP = {'2': Certificate.PREPARED,
 # relative path from manage.py to the refCountries.csv file
 COUNTRY_CSV = './data/refCountries.csv'
 
+# Physical lines beginning a new record: integer PK followed by a 'US' Certificate Identifier
+RECORD_START = re.compile(r'\d+,US')
+
+# Row problem report
+WARNING = 'warning'
+ERROR = 'error'
+REPORT_HEADER = ['record', 'certificate', 'level', 'message']
+
 
 class Command(BaseCommand):
     help = 'Load certificate data from csv export'
@@ -32,26 +47,173 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('filepath', type=str)
         parser.add_argument('--limit', dest='limit', nargs='?', type=int)
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                            help='Certificates inserted per transaction')
+        parser.add_argument('--checkpoint', dest='checkpoint',
+                            help='Checkpoint file, defaults to <filepath>.checkpoint')
+        parser.add_argument('--resume', action='store_true', dest='resume',
+                            help='Continue from the checkpoint of a failed run')
+        parser.add_argument('--copy', action='store_true', dest='copy',
+                            help='Insert with PostgreSQL COPY, recording history for each certificate')
+        parser.add_argument('--workers', dest='workers', type=int, default=os.cpu_count() or 1,
+                            help='Processes transforming rows, 1 transforms in-process')
+        parser.add_argument('--report', dest='report',
+                            help='CSV report of row warnings and errors, defaults to <filepath>.report.csv')
 
     def handle(self, *args, **options):
         filepath = options['filepath']
         self.limit = options['limit']
+        self.batch_size = options['batch_size']
+        self.copy = options['copy']
+        self.workers = options['workers']
+        self.checkpoint_path = options['checkpoint'] or f'{filepath}.checkpoint'
+        self.report_path = options['report'] or f'{filepath}.report.csv'
         if self.limit:
             self.stdout.write(f'Limiting to {self.limit} rows.')
 
-        self.stdout.write(f'Reading data from {filepath}...')
-        self.rectified_csv = rectify_csv(filepath)
-        self.stdout.write("Newlines converted to '|'")
-
-        self.licensee_id_list = list(
+        licensee_ids = set(
             Licensee.objects.all().values_list('id', flat=True))
-        self.port_of_export_map = {
+        port_of_export_map = {
             poe.name: poe.id for poe in PortOfExport.objects.all()}
 
         self.stdout.write(f"Reading country data from {COUNTRY_CSV}...")
-        self.countries = build_country_map()
+        self.transformer_args = (licensee_ids, port_of_export_map, build_country_map())
+
+        checkpoint = read_checkpoint(self.checkpoint_path) if options['resume'] else None
+        if checkpoint:
+            self.stdout.write(f"Resuming after {checkpoint['processed']} records.")
+
+        self.stdout.write(f'Reading data from {filepath}...')
+        self.load_certs(filepath, checkpoint)
+
+    def load_certs(self, cert_file, checkpoint=None):
+        checkpoint = checkpoint or {'offset': 0, 'processed': 0, 'excluded': 0, 'failed': 0,
+                                    'warnings': 0}
+        self.counter = checkpoint['processed']
+        self.test_excluded = checkpoint['excluded']
+        self.failed = checkpoint.get('failed', 0)
+        self.warnings = checkpoint.get('warnings', 0)
+        # Certificates of a batch committed before its checkpoint was written may already exist
+        self.skip_existing = checkpoint['offset'] > 0
+        self.started = time.monotonic()
+        self.counted_at_start = self.counter
+
+        report_mode = 'a' if checkpoint['offset'] else 'w'
+        with open(cert_file, 'rb') as infile, open(self.report_path, report_mode, newline='') as report_file:
+            self.report = csv.writer(report_file)
+            if report_mode == 'w':
+                self.report.writerow(REPORT_HEADER)
+
+            records = rectified_records(infile, checkpoint['offset'])
+            header = next(records)[0]
+            fieldnames = next(csv.reader([header]))
+
+            chunks = self.chunk_records(records, self.counter)
+            for chunk_results, offset in transform_pipeline(chunks, self.workers, fieldnames,
+                                                            self.transformer_args):
+                cert_list = self.collect(chunk_results)
+                self.save_batch(cert_list, offset)
+
+        # No checkpoint is written when no batch was saved, e.g. a file with only a header
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Processed {self.counter} certificate records.'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Excluded {self.test_excluded} certificates with Licensee: TEST or Number < 10000'))
+        if self.failed:
+            self.stdout.write(self.style.ERROR(
+                f'Failed to import {self.failed} certificates.'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {self.counter-self.test_excluded-self.failed} certificates!'))
+        if self.warnings or self.failed:
+            self.stdout.write(self.style.WARNING(
+                f'{self.warnings} warnings and {self.failed} errors written to {self.report_path}'))
+
+    def chunk_records(self, records, counter):
+        """Group records into batches, stopping at the row limit"""
+        chunk = []
+        for record in records:
+            if self.limit and counter >= self.limit:
+                break
+            counter += 1
+            chunk.append((counter, record[0], record[1]))
+            if len(chunk) == self.batch_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def collect(self, chunk_results):
+        """Tally transformed rows and report their problems, returning certificates to insert"""
+        cert_list = []
+        for record_number, number, cert, excluded, problems in chunk_results:
+            self.counter = record_number
+            for level, message in problems:
+                self.report.writerow([record_number, number, level, message])
+                if level == ERROR:
+                    self.failed += 1
+                else:
+                    self.warnings += 1
+            if excluded:
+                self.test_excluded += 1
+            elif cert is not None:
+                cert_list.append(cert)
+        return cert_list
+
+    def save_batch(self, cert_list, offset):
+        """Insert a batch of certificates and record how far into the file we have read"""
+        if self.skip_existing and cert_list:
+            existing = set(Certificate.objects.filter(
+                number__in=[cert.number for cert in cert_list]).values_list('number', flat=True))
+            cert_list = [cert for cert in cert_list if cert.number not in existing]
+            self.skip_existing = False
+
+        with buffered_history():
+            if self.copy:
+                copy_instances(Certificate, cert_list)
+            else:
+                record_history(Certificate.objects.bulk_create(cert_list), history_type='+')
+        write_checkpoint(self.checkpoint_path, {'offset': offset, 'processed': self.counter,
+                                                'excluded': self.test_excluded,
+                                                'failed': self.failed, 'warnings': self.warnings})
+
+        elapsed = time.monotonic() - self.started
+        rate = (self.counter - self.counted_at_start) / elapsed if elapsed else 0
+        self.stdout.write(f'Processed {self.counter} records ({rate:.0f} rows/sec)')
+
+
+class CertificateTransformer(object):
+    """Transform legacy CSV rows into unsaved Certificates, noting any problems"""
+
+    def __init__(self, licensee_ids, port_of_export_map, countries):
+        self.licensee_id_list = licensee_ids
+        self.port_of_export_map = port_of_export_map
+        self.countries = countries
+
+    def transform(self, row):
+        """
+        Returns (certificate number, certificate, excluded, problems)
+        certificate is None for excluded rows and rows which could not be transformed
+        """
+        self.number = None
+        self.problems = []
+        try:
+            cert = self.make_certificate(row)
+        except Exception as e:
+            self.problems.append((ERROR, f'{type(e).__name__}: {e}'))
+            return self.number, None, False, self.problems
+        return self.number, cert, cert is None, self.problems
+
+    def warn(self, message):
+        self.problems.append((WARNING, message))
 
-        self.load_certs(filepath)
+    def prepare_date(self, value):
+        try:
+            return prepare_date(value)
+        except ValueError:
+            self.warn(f'Could not parse date: {value}')
 
     def get_country(self, value):
         """Get Country object for incoming country value"""
@@ -61,69 +223,40 @@ class Command(BaseCommand):
             value = Country(code=value)
         return value
 
-    def load_certs(self, cert_file):
-        self.counter = 0
-        self.test_excluded = 0
-        cert_list = []
-
-        reader = csv.DictReader(self.rectified_csv)
-        for row in reader:
-            self.counter += 1
-            if self.limit and self.counter > self.limit:
-                break
-
-            cert = self.make_certificate(row)
-            if cert:
-                cert_list.append(cert)
-
-        Certificate.objects.bulk_create(cert_list)
-
-        self.stdout.write(self.style.SUCCESS(
-            f'Processed {self.counter} certificate records.'))
-        self.stdout.write(self.style.SUCCESS(
-            f'Excluded {self.test_excluded} certificates with Licensee: TEST or Number < 10000'))
-        self.stdout.write(self.style.SUCCESS(
-            f'Imported {self.counter-self.test_excluded} certificates!'))
-
     def make_certificate(self, row):
         """Parse CSV row into Certificate object"""
         cert = Certificate()
         cert.number = prepare_number(row['CertNumber'])
+        self.number = cert.number
 
         licensee_id = int(row['LicenseeID'])
         # Ignore TEST(17) or 34 licensee records and
         # and Certificate numbers with less than 5 digits
         if licensee_id in(17, 34) or cert.number < 10000:
-            self.test_excluded += 1
             return
         if licensee_id in self.licensee_id_list:
             cert.licensee_id = licensee_id
         else:
-            self.stdout.write(self.style.WARNING(
-                f"{cert}: Could not find Licensee ({licensee_id}), setting to None"))
+            self.warn(f"Could not find Licensee ({licensee_id}), setting to None")
 
         try:
             cert.aes = prepare_aes(row['AESNUmber'])
             if cert.aes:
                 validate_aes(cert.aes)
         except ValidationError:
-            pass
-            self.stdout.write(self.style.WARNING(
-                f"{cert}: Invalid AES: ({cert.aes}) importing as-is."))
+            self.warn(f"Invalid AES: ({cert.aes}) importing as-is.")
 
         poe = prepare_poe(row['PortOfExport'])
         if poe:
             try:
                 cert.port_of_export_id = self.port_of_export_map[poe]
             except KeyError:
-                self.stdout.write(self.style.WARNING(
-                    f"{cert}: Unknown Port of Export: ({poe}) setting to None"))
+                self.warn(f"Unknown Port of Export: ({poe}) setting to None")
 
         try:
             cert.void = prepare_boolean(row['VoidCert'])
         except ValueError:
-            self.stdout.write(self.style.WARNING(
-                    f"{cert}: Unknown Void value of {row['VoidCert']}: Setting VOID to True"))
+            self.warn(f"Unknown Void value of {row['VoidCert']}: Setting VOID to True")
             cert.void = True
         cert.notes = ignore_null_str(row['VoidComment'])
 
@@ -136,13 +269,11 @@ class Command(BaseCommand):
             try:
                 cert.status = STATUS_MAP[status_id]
             except KeyError:
-                self.stdout.write(self.style.WARNING(
-                    f"{cert}: Could not parse Status ({status_id})"))
+                self.warn(f"Could not parse Status ({status_id})")
         try:
             cert.harmonized_code_id = prepare_hscode(row['HCDCodeID'])
         except KeyError:
-            self.stdout.write(self.style.WARNING(
-                f"{cert}: Could not parse HSCode ({row['HCDCodeID']}), setting to None"))
+            self.warn(f"Could not parse HSCode ({row['HCDCodeID']}), setting to None")
 
         cert.consignee = ignore_null_str(row['Importer'])
         cert.consignee_address = prepare_address(
@@ -152,8 +283,7 @@ class Command(BaseCommand):
             consignee_country = self.get_country(
                 row['ImporterCountry'])
         except KeyError:
-            self.stdout.write(self.style.WARNING(
-                f"{cert}: Could not find Country ID ({row['ImporterCountry']}), setting to None"))
+            self.warn(f"Could not find Country ID ({row['ImporterCountry']}), setting to None")
             consignee_country = None
 
         # add country to consignee address
@@ -162,12 +292,12 @@ class Command(BaseCommand):
             cert.consignee_address += f'\n{consignee_country.name}'
 
         cert.shipped_value = prepare_decimal(row['ShippedValue'])
-        cert.date_of_sale = prepare_date(row['DateOfSale'])
-        cert.date_of_issue = prepare_date(row['DateOfIssue'])
-        cert.date_of_expiry = prepare_date(row['DateOfExpiry'])
-        cert.date_of_delivery = prepare_date(row['DeliveryDate'])
-        cert.date_of_shipment = prepare_date(row['ShipDate'])
-        cert.date_voided = prepare_date(row['VoidDate'])
+        cert.date_of_sale = self.prepare_date(row['DateOfSale'])
+        cert.date_of_issue = self.prepare_date(row['DateOfIssue'])
+        cert.date_of_expiry = self.prepare_date(row['DateOfExpiry'])
+        cert.date_of_delivery = self.prepare_date(row['DeliveryDate'])
+        cert.date_of_shipment = self.prepare_date(row['ShipDate'])
+        cert.date_voided = self.prepare_date(row['VoidDate'])
 
         # get most recent date to set last_modified
         dates = [cert.date_of_sale, cert.date_of_issue,
@@ -184,35 +314,99 @@ class Command(BaseCommand):
         return cert
 
 
-def rectify_csv(filepath):
+# Transformer used by each worker process, created by _init_worker
+_transformer = None
+_fieldnames = None
+
+
+def _init_worker(fieldnames, transformer_args):
+    global _transformer, _fieldnames
+    _fieldnames = fieldnames
+    _transformer = CertificateTransformer(*transformer_args)
+
+
+def _transform_chunk(chunk):
+    """Transform a chunk of (record number, line, offset) records"""
+    results = []
+    for record_number, line, offset in chunk:
+        row = next(csv.DictReader([line], fieldnames=_fieldnames))
+        results.append((record_number, *_transformer.transform(row)))
+    return results, chunk[-1][2]
+
+
+def transform_pipeline(chunks, workers, fieldnames, transformer_args):
+    """
+    Transform chunks of records, in order, using a pool of worker processes
+
+    At most two chunks per worker are in flight, bounding
+    memory use regardless of input size.
+    """
+    if workers <= 1:
+        _init_worker(fieldnames, transformer_args)
+        yield from map(_transform_chunk, chunks)
+        return
+
+    # Workers never use the database, do not share this process's connection with them
+    connection.close()
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(fieldnames, transformer_args)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_transform_chunk, (chunk,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def rectified_records(infile, offset=0):
     """
     Input CSV contains newlines embedded in address fields
     Identify these newlines and replace them
     with `|` characters.
 
     The values of the first column have a known and expected format
-    An integer primary key value, followed by a 'US\d.' Certificate Identifier
-    regex; '/\d.,US/'
+    An integer primary key value, followed by a 'US\\d.' Certificate Identifier.
+    Physical lines which do NOT begin this way continue the previous record.
 
-    We use this information to identify offending newlines
-    Regex below captures new lines which are NOT followed
-    by the expected integer PK and Certificate identifier fields
+    Yields the header, then each record starting from byte `offset`, along
+    with the byte offset at which the following record begins.
     """
-    pattern = re.compile(r'''
-                        (\n)       # Capture new-line for replacement
-                        (?!        # Negative look ahead
-                            \d+     # One or more digit
-                            ,       # CSV field separator
-                            US|$    # 'US' portion of expected following field OR end of line
-                        )
-                        ''', re.VERBOSE)
-    output = io.StringIO()
-    with open(filepath) as infile:
-        f = infile.read()
-        result = pattern.sub('|', f)
-        output.write(result)
-    output.seek(0)
-    return output
+    header = infile.readline()
+    yield header.decode().rstrip('\r\n'), infile.tell()
+
+    if offset:
+        infile.seek(offset)
+    position = infile.tell()
+
+    record = None
+    for line in infile:
+        text = line.decode().rstrip('\r\n')
+        if record is not None and not RECORD_START.match(text):
+            record += '|' + text
+        else:
+            if record is not None:
+                yield record, position
+            record = text
+        position += len(line)
+    if record is not None:
+        yield record, position
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path, checkpoint):
+    """Atomically replace the checkpoint file"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
 
 
 # data migration transformations
@@ -346,13 +540,10 @@ def prepare_decimal(value):
 
 
 def prepare_date(value):
+    """Date from legacy timestamp, raises ValueError if unparseable"""
     value = ignore_null(value)
     if value:
-        try:
-            dt = datetime.strptime(value, EXPECTED_DATE_FORMAT).date()
-            return dt
-        except ValueError:
-            print(f'Could not parse date: {value}')
+        return datetime.strptime(value, EXPECTED_DATE_FORMAT).date()
 
 
 def prepare_address(value):
@@ -1,5 +1,8 @@
 import csv
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from kpc.bulk import copy_instances, reset_sequence
+from kpc.history import buffered_history, record_history
 from kpc.models import Licensee
 
 # US State ID values from tblStates.csv
@@ -26,10 +29,13 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('filepath', type=str)
         parser.add_argument('--limit', dest='limit', nargs='?', type=int)
+        parser.add_argument('--copy', action='store_true', dest='copy',
+                            help='Insert with PostgreSQL COPY, recording history for each licensee')
 
     def handle(self, *args, **options):
         filepath = options['filepath']
         self.limit = options['limit']
+        self.copy = options['copy']
         if self.limit:
             self.stdout.write(f'Limiting to {self.limit} rows.')
         self.load(filepath)
@@ -59,6 +65,12 @@ class Command(BaseCommand):
                 counter += 1
                 if self.limit and counter > self.limit:
                     break
-            Licensee.objects.bulk_create(licensee_list)
+            if self.copy:
+                with transaction.atomic():
+                    copy_instances(Licensee, licensee_list)
+                    reset_sequence(Licensee)
+            else:
+                with buffered_history():
+                    record_history(Licensee.objects.bulk_create(licensee_list), history_type='+')
             self.stdout.write(self.style.SUCCESS(
                 f'Imported {counter} licensees!'))
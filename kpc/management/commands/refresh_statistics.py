@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from kpc.models import CertificateStatistic
+
+
+class Command(BaseCommand):
+    help = 'Refresh certificate statistics if certificates have changed since the last refresh'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', dest='force',
+                            help='Refresh even if no certificates have been modified')
+
+    def handle(self, *args, **options):
+        if not options['force'] and not CertificateStatistic.is_stale():
+            self.stdout.write('Statistics are up to date.')
+            return
+        CertificateStatistic.refresh()
+        self.stdout.write(self.style.SUCCESS(
+            f'Statistics refreshed at {CertificateStatistic.refreshed()}'))
@@ -0,0 +1,29 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from kpc.mail import send_queued_email
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued email, retrying failed messages with exponential backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, dest='batch_size',
+                            default=settings.EMAIL_QUEUE_BATCH_SIZE,
+                            help='Messages sent per connection to the mail backend')
+        parser.add_argument('--loop', action='store_true', dest='loop',
+                            help='Keep polling the queue instead of exiting once it is drained')
+        parser.add_argument('--interval', type=float, dest='interval', default=10,
+                            help='Seconds to wait between polls of an empty queue')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_queued_email(options['batch_size'])
+            if sent or failed:
+                self.stdout.write(f'Sent {sent} message(s), {failed} failed')
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
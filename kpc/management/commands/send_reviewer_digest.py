@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from kpc.mail import queue_reviewer_digest
+from kpc.models import CertificateConfig
+
+
+class Command(BaseCommand):
+    help = 'Queue reviewers a summary of pending edit requests not yet included in a digest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', dest='base_url',
+                            help='Site URL for links, defaults to the SITE_URL setting')
+
+    def handle(self, *args, **options):
+        if not CertificateConfig.get_solo().reviewer_digest:
+            self.stdout.write('Reviewer digest is not enabled in the certificate configuration.')
+            return
+        count = queue_reviewer_digest(options['base_url'])
+        self.stdout.write(self.style.SUCCESS(f'Queued digest of {count} edit request(s)'))
@@ -0,0 +1,37 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from kpc.forms import BulkVoidForm
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Void certificates by number or range, e.g. a lost book of blank certificates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('numbers', nargs='+',
+                            help='Certificate numbers (US1234) or ranges (US1000-US2000)')
+        parser.add_argument('--user', required=True,
+                            help='Username the certificates are voided by, who must be able to edit them')
+        parser.add_argument('--reason', required=True, help='Void reason, or Other with --notes')
+        parser.add_argument('--notes', default='', help='Notes recorded in place of the reason')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['user']} not found")
+        if not user.profile.can_edit_certs():
+            raise CommandError(f'{user} may not void certificates')
+
+        form = BulkVoidForm({'numbers': ','.join(options['numbers']), 'reason': options['reason'],
+                             'notes': options['notes'], 'void': True},
+                            certificates=user.profile.certificates())
+        if not form.is_valid():
+            raise CommandError(' '.join(error for errors in form.errors.values() for error in errors))
+        already_void = form.selected.filter(void=True).count()
+        count = form.save(user)
+        self.stdout.write(self.style.SUCCESS(form.SUCCESS_MSG % count))
+        if already_void:
+            self.stdout.write(form.ALREADY_VOID % already_void)
@@ -0,0 +1,69 @@
+# Generated by Django 2.0.6 on 2026-10-18 08:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpc', '0003_auto_20180608_0907'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['status', 'number'], name='kpc_cert_status_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['last_modified', 'number'], name='kpc_cert_modified_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['aes', 'number'], name='kpc_cert_aes_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['consignee', 'number'], name='kpc_cert_consignee_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['shipped_value', 'number'], name='kpc_cert_value_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['date_of_issue', 'number'], name='kpc_cert_issued_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['date_of_sale', 'number'], name='kpc_cert_sold_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['date_of_expiry', 'number'], name='kpc_cert_expiry_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['number_of_parcels', 'number'], name='kpc_cert_parcels_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['carat_weight', 'number'], name='kpc_cert_carats_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['exporter', 'number'], name='kpc_cert_exporter_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['date_of_shipment', 'number'], name='kpc_cert_shipped_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['date_of_delivery', 'number'], name='kpc_cert_delivered_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='certificate',
+            index=models.Index(fields=['date_voided', 'number'], name='kpc_cert_voided_num_idx'),
+        ),
+    ]
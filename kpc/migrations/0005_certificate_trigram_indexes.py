@@ -0,0 +1,30 @@
+# Generated by Django 2.0.6 on 2026-10-18 11:20
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# Columns filtered with icontains, which PostgreSQL evaluates as UPPER(column::text) LIKE UPPER(...)
+TEXT_SEARCH_COLUMNS = ['aes', 'exporter', 'exporter_address', 'consignee', 'consignee_address']
+
+
+def create_index(column):
+    return (f'CREATE INDEX kpc_cert_{column}_trgm_idx ON kpc_certificate '
+            f'USING gin (UPPER({column}::text) gin_trgm_ops);')
+
+
+def drop_index(column):
+    return f'DROP INDEX kpc_cert_{column}_trgm_idx;'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpc', '0004_certificate_sort_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+    ] + [
+        migrations.RunSQL(create_index(column), drop_index(column))
+        for column in TEXT_SEARCH_COLUMNS
+    ]
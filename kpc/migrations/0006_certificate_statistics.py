@@ -0,0 +1,52 @@
+# Generated by Django 2.0.6 on 2026-10-18 12:05
+
+from django.db import migrations, models
+import django_countries.fields
+
+CREATE_STATS_VIEW = '''
+CREATE MATERIALIZED VIEW kpc_certificate_stats AS
+SELECT row_number() OVER () AS id, stats.*, now() AS refreshed_at
+FROM (
+    SELECT licensee_id, status, country_of_origin, port_of_export_id,
+           date_trunc('month', COALESCE(date_of_issue, date_of_sale))::date AS month,
+           count(*) AS certificates,
+           sum(shipped_value) AS shipped_value,
+           sum(carat_weight) AS carat_weight
+    FROM kpc_certificate
+    GROUP BY 1, 2, 3, 4, 5
+) AS stats;
+
+-- Required to refresh concurrently
+CREATE UNIQUE INDEX kpc_certificate_stats_key
+    ON kpc_certificate_stats (licensee_id, status, country_of_origin, port_of_export_id, month);
+'''
+
+DROP_STATS_VIEW = 'DROP MATERIALIZED VIEW kpc_certificate_stats;'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpc', '0005_certificate_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_STATS_VIEW, DROP_STATS_VIEW),
+        migrations.CreateModel(
+            name='CertificateStatistic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.IntegerField(choices=[(0, 'Available'), (1, 'Prepared'), (2, 'Shipped'), (3, 'Delivered'), (4, 'Void')])),
+                ('country_of_origin', django_countries.fields.CountryField(blank=True, max_length=2)),
+                ('month', models.DateField(null=True)),
+                ('certificates', models.PositiveIntegerField()),
+                ('shipped_value', models.DecimalField(decimal_places=2, max_digits=30, null=True)),
+                ('carat_weight', models.DecimalField(decimal_places=2, max_digits=30, null=True)),
+                ('refreshed_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'kpc_certificate_stats',
+                'managed': False,
+            },
+        ),
+    ]
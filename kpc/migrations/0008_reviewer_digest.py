@@ -0,0 +1,33 @@
+# Generated by Django 2.0.6 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpc', '0007_queuedemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='certificateconfig',
+            name='last_reviewer_digest',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='certificateconfig',
+            name='reviewer_digest',
+            field=models.BooleanField(default=False, help_text='If True, reviewers receive a periodic summary of new edit requests instead of an email for each request.', verbose_name='Reviewer Digest'),
+        ),
+        migrations.AddField(
+            model_name='historicalcertificateconfig',
+            name='last_reviewer_digest',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='historicalcertificateconfig',
+            name='reviewer_digest',
+            field=models.BooleanField(default=False, help_text='If True, reviewers receive a periodic summary of new edit requests instead of an email for each request.', verbose_name='Reviewer Digest'),
+        ),
+    ]
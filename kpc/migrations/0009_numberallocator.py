@@ -0,0 +1,20 @@
+# Generated by Django 2.0.6 on 2026-10-18 15:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpc', '0008_reviewer_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NumberAllocator',
+            fields=[
+                ('name', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('next_value', models.BigIntegerField()),
+            ],
+        ),
+    ]
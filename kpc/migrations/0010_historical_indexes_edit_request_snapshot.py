@@ -0,0 +1,32 @@
+# Generated by Django 2.0.6 on 2026-10-18 15:20
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpc', '0009_numberallocator'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='editrequest',
+            name='certificate_snapshot',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, editable=False, encoder=django.core.serializers.json.DjangoJSONEncoder, help_text='Certificate values when this change was requested', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='historicalcertificate',
+            index=models.Index(fields=['id', 'history_date'], name='kpc_histori_id_89b881_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='historicallicensee',
+            index=models.Index(fields=['id', 'history_date'], name='kpc_histori_id_271045_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='historicalreceipt',
+            index=models.Index(fields=['id', 'history_date'], name='kpc_histori_id_8923ba_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.0.6 on 2026-10-18 15:40
+
+from django.db import migrations
+
+# Address book autocompletion filters with istartswith, which PostgreSQL
+# evaluates as UPPER(name::text) LIKE UPPER('prefix%')
+CREATE_INDEX = ('CREATE INDEX kpc_kpcaddress_name_prefix_idx ON kpc_kpcaddress '
+                '(licensee_id, UPPER(name::text) text_pattern_ops);')
+DROP_INDEX = 'DROP INDEX kpc_kpcaddress_name_prefix_idx;'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpc', '0010_historical_indexes_edit_request_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_INDEX, DROP_INDEX),
+    ]
@@ -0,0 +1,100 @@
+# Generated by Django 2.0.6 on 2026-10-18 16:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_countries.fields
+
+# Rows are keyed by their dimensions, rather than a row number and a per-row
+# refresh time, so a concurrent refresh only rewrites rows whose totals changed.
+# The refresh time is stored once on CertificateConfig.
+CREATE_STATS_VIEW = '''
+DROP MATERIALIZED VIEW kpc_certificate_stats;
+
+CREATE MATERIALIZED VIEW kpc_certificate_stats AS
+SELECT concat_ws('/', COALESCE(licensee_id::text, ''), status, country_of_origin,
+                 COALESCE(port_of_export_id::text, ''), COALESCE(month::text, '')) AS key,
+       stats.*
+FROM (
+    SELECT licensee_id, status, country_of_origin, port_of_export_id,
+           date_trunc('month', COALESCE(date_of_issue, date_of_sale))::date AS month,
+           count(*) AS certificates,
+           sum(shipped_value) AS shipped_value,
+           sum(carat_weight) AS carat_weight
+    FROM kpc_certificate
+    GROUP BY 1, 2, 3, 4, 5
+) AS stats;
+
+-- Required to refresh concurrently
+CREATE UNIQUE INDEX kpc_certificate_stats_key ON kpc_certificate_stats (key);
+'''
+
+RESTORE_STATS_VIEW = '''
+DROP MATERIALIZED VIEW kpc_certificate_stats;
+
+CREATE MATERIALIZED VIEW kpc_certificate_stats AS
+SELECT row_number() OVER () AS id, stats.*, now() AS refreshed_at
+FROM (
+    SELECT licensee_id, status, country_of_origin, port_of_export_id,
+           date_trunc('month', COALESCE(date_of_issue, date_of_sale))::date AS month,
+           count(*) AS certificates,
+           sum(shipped_value) AS shipped_value,
+           sum(carat_weight) AS carat_weight
+    FROM kpc_certificate
+    GROUP BY 1, 2, 3, 4, 5
+) AS stats;
+
+CREATE UNIQUE INDEX kpc_certificate_stats_key
+    ON kpc_certificate_stats (licensee_id, status, country_of_origin, port_of_export_id, month);
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpc', '0011_kpcaddress_name_prefix_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_STATS_VIEW, RESTORE_STATS_VIEW),
+        migrations.DeleteModel(
+            name='CertificateStatistic',
+        ),
+        migrations.CreateModel(
+            name='CertificateStatistic',
+            fields=[
+                ('key', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('status', models.IntegerField(choices=[(0, 'Available'), (1, 'Prepared'), (2, 'Shipped'), (3, 'Delivered'), (4, 'Void')])),
+                ('country_of_origin', django_countries.fields.CountryField(blank=True, max_length=2)),
+                ('month', models.DateField(null=True)),
+                ('certificates', models.PositiveIntegerField()),
+                ('shipped_value', models.DecimalField(decimal_places=2, max_digits=30, null=True)),
+                ('carat_weight', models.DecimalField(decimal_places=2, max_digits=30, null=True)),
+                ('licensee', models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='kpc.Licensee')),
+                ('port_of_export', models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='kpc.PortOfExport')),
+            ],
+            options={
+                'db_table': 'kpc_certificate_stats',
+                'managed': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='certificateconfig',
+            name='statistics_certificates',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='certificateconfig',
+            name='statistics_refreshed',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='historicalcertificateconfig',
+            name='statistics_certificates',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='historicalcertificateconfig',
+            name='statistics_refreshed',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.6 on 2026-10-18 16:30
+
+from django.db import migrations, models
+
+
+def mark_digested(apps, schema_editor):
+    """Requests submitted before the last digest were included in it"""
+    CertificateConfig = apps.get_model('kpc', 'CertificateConfig')
+    EditRequest = apps.get_model('kpc', 'EditRequest')
+    config = CertificateConfig.objects.first()
+    if config and config.last_reviewer_digest:
+        (EditRequest.objects.filter(date_requested__lte=config.last_reviewer_digest)
+         .update(digested_at=config.last_reviewer_digest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpc', '0012_certificate_statistics_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='editrequest',
+            name='digested_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When this request was included in a reviewer digest', null=True),
+        ),
+        migrations.RunPython(mark_digested, migrations.RunPython.noop),
+    ]
@@ -1,17 +1,25 @@
+import copy
 import datetime
+import uuid
 from decimal import Decimal
 
 from django.conf import settings
-from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.core.cache import caches
+from django.core.mail import EmailMultiAlternatives
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator, RegexValidator
-from django.db import models
+from django.db import connection, models, transaction
 from django.http import QueryDict
 from django.urls import reverse
+from django.utils import timezone
 from django_countries.fields import CountryField
 from localflavor.us.models import USStateField, USZipCodeField
 from simple_history.models import HistoricalRecords
 from solo.models import SingletonModel
 
+from .history import BufferedHistoricalRecords
+
 
 class CertificateConfig(SingletonModel):
     days_to_expiry = models.PositiveIntegerField(default=60)
@@ -21,12 +29,66 @@ class CertificateConfig(SingletonModel):
                                 verbose_name='KP Countries')
     edit_requests = models.BooleanField(default=False, verbose_name='Certificate Edit Requests',
                                         help_text='If True, users will be able to submit a request to modify a prepared certificate.')
+    reviewer_digest = models.BooleanField(default=False, verbose_name='Reviewer Digest',
+                                          help_text='If True, reviewers receive a periodic summary of new edit requests '
+                                                    'instead of an email for each request.')
+    last_reviewer_digest = models.DateTimeField(blank=True, null=True, editable=False)
+    # Time of, and certificates counted at, the last statistics refresh
+    statistics_refreshed = models.DateTimeField(blank=True, null=True, editable=False)
+    statistics_certificates = models.PositiveIntegerField(blank=True, null=True, editable=False)
 
     history = HistoricalRecords()
 
+    # (version, instance) of the configuration last loaded by this process
+    _cached = None
+    CACHE_VERSION_KEY = 'kpc:certificate-config:version'
+
     def __str__(self):
         return "Configuration"
 
+    @classmethod
+    def _version_cache(cls):
+        return caches[settings.CERTIFICATE_CONFIG_VERSION_CACHE]
+
+    @classmethod
+    def cache_version(cls):
+        """
+        Version stamp shared by all workers, changed whenever the configuration
+        is saved and renewed when it expires after the config cache timeout
+        """
+        cache = cls._version_cache()
+        version = cache.get(cls.CACHE_VERSION_KEY)
+        if version is None:
+            cache.add(cls.CACHE_VERSION_KEY, uuid.uuid4().hex)
+            version = cache.get(cls.CACHE_VERSION_KEY)
+        return version
+
+    @classmethod
+    def invalidate_cache(cls):
+        """Discard this process's copy and signal other workers to do the same"""
+        cls._cached = None
+        cls._version_cache().set(cls.CACHE_VERSION_KEY, uuid.uuid4().hex)
+
+    @classmethod
+    def get_solo(cls):
+        """
+        Configuration, reused in-process until the shared version stamp changes
+
+        Only committed configuration is kept, reads inside
+        a transaction are cached once that transaction commits.
+        """
+        version = cls.cache_version()
+        cached = cls._cached
+        if cached is not None and cached[0] == version:
+            return copy.copy(cached[1])
+
+        obj = super().get_solo()
+
+        def store():
+            cls._cached = (version, copy.copy(obj))
+        transaction.on_commit(store)
+        return obj
+
     class Meta:
         verbose_name = "Certificate Configuration"
         verbose_name_plural = "Certificate Configuration"
@@ -96,7 +158,7 @@ class Licensee(models.Model):
                               )
     is_active = models.BooleanField(
         default=True, help_text="Licensee is active - able to request and access certificates")
-    history = HistoricalRecords()
+    history = BufferedHistoricalRecords()
 
     class Meta:
         ordering = ['name']
@@ -109,7 +171,7 @@ class Licensee(models.Model):
 
     def user_can_access(self, user):
         return user.is_superuser or user.profile.is_auditor or \
-            user.profile.licensees.filter(id=self.id).exists()
+            user.profile.is_licensee_contact(self.id)
 
     @property
     def address_text(self):
@@ -144,6 +206,46 @@ class KpcAddress(models.Model):
         return reverse('addressee-delete', args=[self.id])
 
 
+class NumberAllocator(models.Model):
+    """
+    Next unallocated value of a number series
+
+    Reserving increments the series' row in place, concurrent reservations
+    queue on its row lock until the reserving transaction ends so no number
+    is handed out twice. Unlike a sequence, numbers reserved by a rolled
+    back transaction are reused, keeping the series free of gaps.
+
+    As the lock is held until commit, reserve as late as possible in the
+    transaction, after any bulk writes, so other reservations are not
+    queued behind them.
+    """
+    RECEIPT = 'receipt'
+    CERTIFICATE = 'certificate'
+
+    name = models.CharField(max_length=32, primary_key=True)
+    next_value = models.BigIntegerField()
+
+    def __str__(self):
+        return f'{self.name}: {self.next_value}'
+
+    @classmethod
+    def reserve(cls, name, count=1, floor=1):
+        """Reserve count consecutive numbers, none lower than floor, returning the first"""
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {cls._meta.db_table} AS allocator (name, next_value)
+                VALUES (%(name)s, %(floor)s + %(count)s)
+                ON CONFLICT (name) DO UPDATE
+                SET next_value = GREATEST(allocator.next_value, %(floor)s) + %(count)s
+                RETURNING next_value - %(count)s""", {'name': name, 'count': count, 'floor': floor})
+            return cursor.fetchone()[0]
+
+    @classmethod
+    def peek(cls, name):
+        """Next value of the series, None if nothing has been reserved"""
+        return cls.objects.filter(name=name).values_list('next_value', flat=True).first()
+
+
 class Receipt(models.Model):
     number = models.IntegerField(
         default=settings.LAST_RECEIPT_NUMBER, unique=True)
@@ -157,17 +259,17 @@ class Receipt(models.Model):
     contact = models.CharField(max_length=256)
     date_sold = models.DateField()
 
-    history = HistoricalRecords()
+    history = BufferedHistoricalRecords()
 
     class Meta:
         ordering = ['-number']
 
     def save(self, *args, **kwargs):
-        """Auto-increment number"""
+        """Allocate the next receipt number"""
         if not self.id:
-            last_receipt = Receipt.objects.first()
-            if last_receipt:
-                self.number = last_receipt.number + 1
+            latest = Receipt.objects.aggregate(models.Max('number'))['number__max']
+            floor = max(settings.LAST_RECEIPT_NUMBER, (latest or 0) + 1)
+            self.number = NumberAllocator.reserve(NumberAllocator.RECEIPT, floor=floor)
         super().save(*args, **kwargs)
 
     @classmethod
@@ -240,6 +342,21 @@ class BaseCertificate(models.Model):
         abstract = True
 
 
+class CertificateQuerySet(models.QuerySet):
+
+    def with_edit_state(self):
+        """
+        Attach pending edit requests and the edit request feature flag in bulk,
+        so pending_edit and show_edit_link do not query per certificate
+        """
+        pending = EditRequest.objects.filter(
+            status=EditRequest.PENDING).order_by('-date_requested')
+        enabled = CertificateConfig.get_solo().edit_requests
+        return self.prefetch_related(
+            models.Prefetch('edit_requests', queryset=pending, to_attr='pending_edits')
+        ).annotate(edit_requests_enabled=models.Value(enabled, output_field=models.BooleanField()))
+
+
 class Certificate(BaseCertificate):
     AVAILABLE = 0
     PREPARED = 1
@@ -250,6 +367,7 @@ class Certificate(BaseCertificate):
     DEFAULT_SEARCH = [AVAILABLE, PREPARED, SHIPPED]
     DEFAULT_AUDITOR_SEARCH = [PREPARED, SHIPPED, DELIVERED]
     MODIFIABLE_STATUSES = [PREPARED, SHIPPED]
+    PRINTABLE_STATUSES = [PREPARED, SHIPPED, DELIVERED]
 
     STATUS_CHOICES = (
         (AVAILABLE, 'Available'),
@@ -298,10 +416,29 @@ class Certificate(BaseCertificate):
         blank=True, null=True, help_text='Date certificate was marked DELIVERED')
     date_voided = models.DateField(
         blank=True, null=True, help_text="Date on which this certificate was voided")
-    history = HistoricalRecords()
+    history = BufferedHistoricalRecords()
+
+    objects = CertificateQuerySet.as_manager()
 
     class Meta:
         get_latest_by = ('number', )
+        # (column, number) indexes backing keyset pagination of the certificate listing
+        indexes = [
+            models.Index(fields=['status', 'number'], name='kpc_cert_status_num_idx'),
+            models.Index(fields=['last_modified', 'number'], name='kpc_cert_modified_num_idx'),
+            models.Index(fields=['aes', 'number'], name='kpc_cert_aes_num_idx'),
+            models.Index(fields=['consignee', 'number'], name='kpc_cert_consignee_num_idx'),
+            models.Index(fields=['shipped_value', 'number'], name='kpc_cert_value_num_idx'),
+            models.Index(fields=['date_of_issue', 'number'], name='kpc_cert_issued_num_idx'),
+            models.Index(fields=['date_of_sale', 'number'], name='kpc_cert_sold_num_idx'),
+            models.Index(fields=['date_of_expiry', 'number'], name='kpc_cert_expiry_num_idx'),
+            models.Index(fields=['number_of_parcels', 'number'], name='kpc_cert_parcels_num_idx'),
+            models.Index(fields=['carat_weight', 'number'], name='kpc_cert_carats_num_idx'),
+            models.Index(fields=['exporter', 'number'], name='kpc_cert_exporter_num_idx'),
+            models.Index(fields=['date_of_shipment', 'number'], name='kpc_cert_shipped_num_idx'),
+            models.Index(fields=['date_of_delivery', 'number'], name='kpc_cert_delivered_num_idx'),
+            models.Index(fields=['date_voided', 'number'], name='kpc_cert_voided_num_idx'),
+        ]
 
     def __str__(self):
         return self.display_name
@@ -331,9 +468,10 @@ class Certificate(BaseCertificate):
     def next_available_number(cls):
         """Starting point for new certificate ID generation"""
         try:
-            return cls.objects.latest().number + 1
+            available = cls.objects.latest().number + 1
         except cls.DoesNotExist:
-            return 1
+            available = 1
+        return max(available, NumberAllocator.peek(NumberAllocator.CERTIFICATE) or 1)
 
     @classmethod
     def default_search_filters(cls, user):
@@ -368,13 +506,17 @@ class Certificate(BaseCertificate):
 
     def user_can_access(self, user):
         """True if user can access this certificate"""
-        return user.profile.certificates().filter(id=self.id).exists()
+        profile = user.profile
+        return profile.can_access_all_certificates() or \
+            profile.is_licensee_contact(self.licensee_id, active_only=True)
 
     def user_can_edit(self, user):
         return self.user_can_access(user) and user.profile.can_edit_certs()
 
     @property
     def pending_edit(self):
+        if hasattr(self, 'pending_edits'):
+            return self.pending_edits[0] if self.pending_edits else None
         try:
             return self.edit_requests.filter(status=EditRequest.PENDING).latest("date_requested")
         except EditRequest.DoesNotExist:
@@ -399,7 +541,10 @@ class Certificate(BaseCertificate):
     @property
     def show_edit_link(self):
         """Show link if feature enabled and no pending edit request"""
-        return CertificateConfig.get_solo().edit_requests and not self.pending_edit
+        enabled = getattr(self, 'edit_requests_enabled', None)
+        if enabled is None:
+            enabled = CertificateConfig.get_solo().edit_requests
+        return enabled and not self.pending_edit
 
 
 class EditRequest(BaseCertificate):
@@ -422,6 +567,10 @@ class EditRequest(BaseCertificate):
     date_reviewed = models.DateTimeField(blank=True, null=True)
     reviewed_by = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True,
                                     on_delete=models.PROTECT, related_name='reviewed_edit_requests')
+    certificate_snapshot = JSONField(blank=True, null=True, editable=False, encoder=DjangoJSONEncoder,
+                                     help_text='Certificate values when this change was requested')
+    digested_at = models.DateTimeField(blank=True, null=True, editable=False,
+                                       help_text='When this request was included in a reviewer digest')
 
     class Meta:
         ordering = ['-date_requested']
@@ -434,10 +583,25 @@ class EditRequest(BaseCertificate):
 
     def user_can_access(self, user):
         """True if user can access the associated certificate"""
-        return user.profile.certificates().filter(id=self.certificate.id).exists()
+        return self.certificate.user_can_access(user)
+
+    def save(self, *args, **kwargs):
+        """Snapshot the certificate, as stored, when the change is requested"""
+        if self._state.adding and self.certificate_snapshot is None:
+            cert = Certificate.objects.get(pk=self.certificate_id)
+            self.certificate_snapshot = {
+                field.attname: field.get_prep_value(field.value_from_object(cert))
+                for field in BaseCertificate._meta.fields}
+        super().save(*args, **kwargs)
 
     def cert_as_of_request(self):
         """Certificate as of date this change was requested"""
+        if self.certificate_snapshot is not None:
+            cert = Certificate(id=self.certificate_id, number=self.certificate.number)
+            for field in BaseCertificate._meta.fields:
+                setattr(cert, field.attname, field.to_python(self.certificate_snapshot.get(field.attname)))
+            return cert
+        # Requests made before snapshots were stored
         try:
             return self.certificate.history.as_of(self.date_requested)
         except Certificate.DoesNotExist:
@@ -479,3 +643,150 @@ class EditRequest(BaseCertificate):
     @property
     def reviewed(self):
         return self.status != self.PENDING
+
+
+class CertificateStatistic(models.Model):
+    """
+    Certificate counts and totals per licensee, status, country of origin,
+    port of export and month (of issue, or of sale if not yet issued)
+
+    Backed by the kpc_certificate_stats materialized view, see refresh(),
+    keyed by its dimensions so a refresh only rewrites changed rows
+    """
+    # Dimensions which statistics may be grouped by, mapped to their lookup
+    DIMENSIONS = {
+        'licensee': 'licensee__name',
+        'status': 'status',
+        'country': 'country_of_origin',
+        'port': 'port_of_export__name',
+        'month': 'month',
+    }
+
+    key = models.CharField(max_length=100, primary_key=True)
+    licensee = models.ForeignKey(Licensee, null=True, on_delete=models.DO_NOTHING, related_name='+')
+    status = models.IntegerField(choices=Certificate.STATUS_CHOICES)
+    country_of_origin = CountryField(blank=True)
+    port_of_export = models.ForeignKey(PortOfExport, null=True, on_delete=models.DO_NOTHING, related_name='+')
+    month = models.DateField(null=True)
+    certificates = models.PositiveIntegerField()
+    shipped_value = models.DecimalField(max_digits=30, decimal_places=2, null=True)
+    carat_weight = models.DecimalField(max_digits=30, decimal_places=2, null=True)
+
+    class Meta:
+        managed = False
+        db_table = 'kpc_certificate_stats'
+
+    @classmethod
+    def _last_refresh(cls):
+        """(time, certificate count) of the last refresh, read past the config cache"""
+        last = CertificateConfig.objects.values_list('statistics_refreshed', 'statistics_certificates').first()
+        return last or (None, None)
+
+    @classmethod
+    def refreshed(cls):
+        """Time statistics were last refreshed"""
+        return cls._last_refresh()[0]
+
+    @classmethod
+    def is_stale(cls):
+        """
+        Certificates have been added, modified or deleted since the last refresh
+
+        Deletes are detected by a change in the number of certificates.
+        """
+        refreshed, count = cls._last_refresh()
+        if refreshed is None:
+            return True
+        current = Certificate.objects.aggregate(latest=models.Max('last_modified'), count=models.Count('id'))
+        return current['count'] != count or (current['latest'] is not None and current['latest'] > refreshed)
+
+    @classmethod
+    def refresh(cls):
+        """Recompute statistics without blocking readers and record when"""
+        refreshed = timezone.now()
+        count = Certificate.objects.count()
+        with connection.cursor() as cursor:
+            cursor.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {cls._meta.db_table}')
+        config = CertificateConfig.get_solo()
+        CertificateConfig.objects.filter(pk=config.pk).update(
+            statistics_refreshed=refreshed, statistics_certificates=count)
+        transaction.on_commit(CertificateConfig.invalidate_cache)
+
+    @classmethod
+    def summarize(cls, group_by, licensee=None, status=None, month_from=None, month_to=None):
+        """Totals grouped by the named DIMENSIONS, optionally filtered"""
+        lookups = [cls.DIMENSIONS[dimension] for dimension in group_by]
+        qs = cls.objects.all()
+        if licensee is not None:
+            qs = qs.filter(licensee=licensee)
+        if status is not None:
+            qs = qs.filter(status=status)
+        if month_from is not None:
+            qs = qs.filter(month__gte=month_from)
+        if month_to is not None:
+            qs = qs.filter(month__lte=month_to)
+        qs = qs.values(*lookups).annotate(
+            total_certificates=models.Sum('certificates'),
+            total_shipped_value=models.Sum('shipped_value'),
+            total_carat_weight=models.Sum('carat_weight'),
+        ).order_by(*lookups)
+        for row in qs:
+            stat = {dimension: row[lookup] for dimension, lookup in zip(group_by, lookups)}
+            if 'status' in stat:
+                stat['status'] = Certificate.get_label_for_status(stat['status'])
+            stat.update(certificates=row['total_certificates'],
+                        shipped_value=row['total_shipped_value'],
+                        carat_weight=row['total_carat_weight'])
+            yield stat
+
+
+class QueuedEmail(models.Model):
+    """
+    Outgoing message awaiting delivery by the send_queued_email command
+
+    Rows are written in the transaction of the change they announce so a
+    notification is only ever sent for a committed change.
+    """
+    PENDING = 0
+    SENT = 1
+    FAILED = 2
+
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (SENT, "Sent"),
+        (FAILED, "Failed")
+    )
+    subject = models.CharField(max_length=998)
+    body = models.TextField()
+    html = models.TextField(blank=True)
+    to = ArrayField(models.EmailField())
+    status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['created']
+        indexes = [models.Index(fields=['status', 'next_attempt'])]
+
+    def __str__(self):
+        return f'{self.subject} to {", ".join(self.to)}'
+
+    def as_message(self, connection=None):
+        msg = EmailMultiAlternatives(subject=self.subject, body=self.body,
+                                     to=self.to, connection=connection)
+        if self.html:
+            msg.attach_alternative(self.html, "text/html")
+        return msg
+
+    def retry_later(self, error):
+        """Record a failed attempt, backing off exponentially until attempts are exhausted"""
+        self.attempts += 1
+        self.last_error = str(error)
+        if self.attempts >= settings.EMAIL_QUEUE_MAX_ATTEMPTS:
+            self.status = self.FAILED
+        else:
+            delay = settings.EMAIL_QUEUE_RETRY_DELAY * 2 ** (self.attempts - 1)
+            self.next_attempt = timezone.now() + datetime.timedelta(seconds=delay)
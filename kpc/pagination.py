@@ -0,0 +1,163 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+
+# Request parameters which do not alter the set of rows being paged through
+NON_FILTER_PARAMS = ('draw', 'start', 'length', '_')
+
+
+def estimated_count(qs):
+    """
+    Row count for the given queryset
+
+    Unfiltered querysets over large tables use the planner's
+    estimate from pg_class rather than a full COUNT(*)
+    """
+    if not qs.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                           [qs.model._meta.db_table])
+            row = cursor.fetchone()
+        if row and row[0] >= settings.DATATABLES_ESTIMATED_COUNT_THRESHOLD:
+            return int(row[0])
+    return qs.count()
+
+
+def seek_filter(field, value, tiebreaker, tiebreaker_value, descending=False):
+    """
+    Q object selecting rows which follow (value, tiebreaker_value)
+    in a (field, tiebreaker) ordering.
+
+    PostgreSQL sorts NULLs last when ascending and first when descending,
+    both are accounted for here so nullable sort columns page correctly.
+    """
+    op = 'lt' if descending else 'gt'
+    following = Q(**{f'{tiebreaker}__{op}': tiebreaker_value})
+
+    if field == tiebreaker:
+        return following
+
+    if value is None:
+        following &= Q(**{f'{field}__isnull': True})
+        if descending:
+            following |= Q(**{f'{field}__isnull': False})
+        return following
+
+    following = Q(**{f'{field}__{op}': value}) | (Q(**{field: value}) & following)
+    if not descending:
+        following |= Q(**{f'{field}__isnull': True})
+    return following
+
+
+class KeysetPaginationMixin(object):
+    """
+    Keyset (seek) pagination for BaseDatatableView
+
+    The position of the last row served is recorded as a bookmark,
+    subsequent pages seek directly to that position through
+    the (sort column, tiebreaker) composite index instead of using OFFSET.
+    Pages without a bookmark fall back to OFFSET, counted from whichever
+    end of the result set is nearest.
+
+    Record counts are cached for DATATABLES_COUNT_CACHE_TIMEOUT seconds.
+    """
+    tiebreaker = 'number'
+
+    def _cache_key(self, *parts):
+        """Cache key unique to this user and their current filters/ordering"""
+        params = sorted((key, self._querydict.getlist(key)) for key in self._querydict
+                        if key not in NON_FILTER_PARAMS)
+        digest = hashlib.sha1(repr((self.request.user.pk, params)).encode()).hexdigest()  # nosec
+        return ':'.join(['keyset', self.__class__.__name__, digest] + [str(part) for part in parts])
+
+    def _cached_count(self, name, qs, counter):
+        key = self._cache_key(name)
+        count = cache.get(key)
+        if count is None:
+            count = counter(qs)
+            cache.set(key, count, settings.DATATABLES_COUNT_CACHE_TIMEOUT)
+        return count
+
+    def _sort_column(self):
+        """Requested (field, descending) sort, defaulting to the tiebreaker"""
+        try:
+            column = int(self._querydict.get('order[0][column]', ''))
+            field = self.get_order_columns()[column]
+        except (ValueError, IndexError):
+            return self.tiebreaker, False
+        return field, self._querydict.get('order[0][dir]') == 'desc'
+
+    def ordering(self, qs):
+        """Order by requested column, using tiebreaker for a stable total order"""
+        field, descending = self.sort_field, self.descending
+        prefix = '-' if descending else ''
+        ordering = [f'{prefix}{field}']
+        if field != self.tiebreaker:
+            ordering.append(f'{prefix}{self.tiebreaker}')
+        return qs.order_by(*ordering)
+
+    def paging(self, qs):
+        limit = min(int(self._querydict.get('length', 10)), self.max_display_length)
+        start = int(self._querydict.get('start', 0))
+        self.start = start
+
+        if limit == -1:
+            return qs
+
+        if start == 0:
+            return qs[:limit]
+
+        bookmark = cache.get(self._cache_key('bookmark', start))
+        if bookmark:
+            value, tiebreaker_value = bookmark
+            return qs.filter(seek_filter(self.sort_field, value, self.tiebreaker,
+                                         tiebreaker_value, self.descending))[:limit]
+
+        remaining = self.total_display_records - start
+        if remaining < start:
+            # Closer to the end, walk backwards and restore requested order
+            end = max(remaining - limit, 0)
+            self.reverse_results = True
+            return qs.reverse()[end:remaining]
+        return qs[start:start + limit]
+
+    def set_bookmark(self, rows):
+        """Record the position of the last row served for the following page"""
+        if not rows:
+            return
+        last = rows[-1]
+        position = self.start + len(rows)
+        cache.set(self._cache_key('bookmark', position),
+                  (last[self.sort_field], last[self.tiebreaker]),
+                  settings.DATATABLES_COUNT_CACHE_TIMEOUT)
+
+    def get_context_data(self, *args, **kwargs):
+        try:
+            self.initialize(*args, **kwargs)
+            self.sort_field, self.descending = self._sort_column()
+            self.reverse_results = False
+
+            qs = self.get_initial_queryset()
+            total_records = self._cached_count('total', qs, estimated_count)
+
+            qs = self.filter_queryset(qs)
+            self.total_display_records = self._cached_count('filtered', qs, estimated_count)
+
+            qs = self.ordering(qs)
+            qs = self.paging(qs)
+
+            data = self.prepare_results(qs)
+            if self.reverse_results:
+                data.reverse()
+            self.set_bookmark(data)
+
+            return {'draw': int(self._querydict.get('draw', 0)),
+                    'recordsTotal': total_records,
+                    'recordsFiltered': self.total_display_records,
+                    'data': data
+                    }
+        except Exception as e:
+            return self.handle_exception(e)
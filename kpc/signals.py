@@ -0,0 +1,26 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .filters import invalidate_filter_cache
+from .models import CertificateConfig, HSCode, Licensee, PortOfExport
+
+
+@receiver([post_save, post_delete], sender=CertificateConfig, dispatch_uid='invalidate_certificate_config')
+def invalidate_certificate_config(sender, created=False, **kwargs):
+    # The configuration is created by the first get_solo(), no worker can hold an earlier copy
+    if created:
+        return
+    # Immediately for this process, again on commit for workers
+    # which reloaded the previous configuration in the meantime
+    CertificateConfig.invalidate_cache()
+    transaction.on_commit(CertificateConfig.invalidate_cache)
+
+
+@receiver([post_save, post_delete], sender=Licensee, dispatch_uid='invalidate_licensee_filters')
+@receiver([post_save, post_delete], sender=HSCode, dispatch_uid='invalidate_hs_code_filters')
+@receiver([post_save, post_delete], sender=PortOfExport, dispatch_uid='invalidate_port_filters')
+@receiver([post_save, post_delete], sender=CertificateConfig, dispatch_uid='invalidate_config_filters')
+def invalidate_certificate_filters(sender, **kwargs):
+    invalidate_filter_cache()
+    transaction.on_commit(invalidate_filter_cache)
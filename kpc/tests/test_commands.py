@@ -0,0 +1,183 @@
+import datetime
+import io
+import os
+import tempfile
+from decimal import Decimal
+from smtplib import SMTPException
+from unittest import mock
+
+from django.conf import settings
+from django.core import mail
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from model_mommy import mommy
+
+from kpc.bulk import CopyStream
+from kpc.management.commands.load_certs import (ERROR, WARNING, CertificateTransformer,
+                                                rectified_records, transform_pipeline)
+from kpc.mail import queue_email
+from kpc.models import Certificate, QueuedEmail
+
+LEGACY_CSV = (b'ID,CertNumber,ImporterAddress\n'
+              b'1,US10001,"1 Street\n'
+              b'City"\n'
+              b'2,US10002,2 Street\n')
+
+
+class RectifiedRecordsTests(SimpleTestCase):
+
+    def test_embedded_newlines_replaced(self):
+        """Lines not beginning a record are joined to the previous record"""
+        records = [record for record, offset in rectified_records(io.BytesIO(LEGACY_CSV))]
+        self.assertEqual(records, ['ID,CertNumber,ImporterAddress',
+                                   '1,US10001,"1 Street|City"',
+                                   '2,US10002,2 Street'])
+
+    def test_resume_from_offset(self):
+        """Offsets yielded with each record resume reading at the following record"""
+        records = list(rectified_records(io.BytesIO(LEGACY_CSV)))
+        resume_at = records[1][1]
+        resumed = [record for record, offset in rectified_records(io.BytesIO(LEGACY_CSV), resume_at)]
+        self.assertEqual(resumed, ['ID,CertNumber,ImporterAddress', '2,US10002,2 Street'])
+
+
+class CopyStreamTests(SimpleTestCase):
+
+    def test_values_formatted_for_copy(self):
+        """NULLs are unquoted, strings are quoted so empty strings survive"""
+        rows = [[1, None, '', 'say "hi"', True, datetime.date(2018, 1, 2), Decimal('1.50')]]
+        self.assertEqual(CopyStream(rows).read(),
+                         '1,,"","say ""hi""",t,2018-01-02,1.50\n')
+
+    def test_read_in_chunks(self):
+        """Reads return at most the requested size until exhausted"""
+        stream = CopyStream([[i] for i in range(100)])
+        chunks = iter(lambda: stream.read(16), '')
+        self.assertEqual(''.join(chunks), ''.join(f'{i}\n' for i in range(100)))
+
+
+LEGACY_ROW = {'CertNumber': 'US12345', 'LicenseeID': '1', 'AESNUmber': 'NULL',
+              'PortOfExport': 'NULL', 'VoidCert': '0', 'VoidComment': 'NULL',
+              'DeliveryStatusID': '2', 'HCDCodeID': '4', 'Importer': 'Importer',
+              'ImporterAddress': '1 Street|City', 'ImporterCountry': '1',
+              'ShippedValue': '10.00', 'DateOfSale': '2018-01-01 00:00:00.000',
+              'DateOfIssue': 'NULL', 'DateOfExpiry': 'NULL', 'DeliveryDate': 'NULL',
+              'ShipDate': 'NULL', 'VoidDate': 'NULL', 'NumberOfParcels': '1',
+              'CaratWeight': '1.5'}
+TRANSFORMER_ARGS = ({1}, {}, {'1': 'AQ'})
+
+
+class CertificateTransformerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.transformer = CertificateTransformer(*TRANSFORMER_ARGS)
+
+    def test_transform(self):
+        """Legacy row transformed without problems"""
+        number, cert, excluded, problems = self.transformer.transform(LEGACY_ROW)
+        self.assertEqual(number, 12345)
+        self.assertEqual(cert.consignee_address, '1 Street\nCity\nAntarctica')
+        self.assertFalse(excluded)
+        self.assertEqual(problems, [])
+
+    def test_warnings_reported(self):
+        """Recoverable problems are reported as warnings"""
+        row = dict(LEGACY_ROW, DateOfIssue='01/01/2018', VoidCert='X')
+        number, cert, excluded, problems = self.transformer.transform(row)
+        self.assertTrue(cert.void)
+        self.assertEqual([level for level, message in problems], [WARNING, WARNING])
+
+    def test_errors_reported(self):
+        """Rows which cannot be transformed are reported as errors"""
+        row = dict(LEGACY_ROW, LicenseeID='NULL')
+        number, cert, excluded, problems = self.transformer.transform(row)
+        self.assertIsNone(cert)
+        self.assertFalse(excluded)
+        self.assertEqual(problems[0][0], ERROR)
+
+    def test_test_licensee_excluded(self):
+        number, cert, excluded, problems = self.transformer.transform(dict(LEGACY_ROW, LicenseeID='17'))
+        self.assertIsNone(cert)
+        self.assertTrue(excluded)
+
+
+class TransformPipelineTests(SimpleTestCase):
+
+    def test_worker_results_in_order(self):
+        """Chunks transformed by worker processes are returned in input order"""
+        fieldnames = list(LEGACY_ROW)
+        line = ','.join(LEGACY_ROW.values()).replace('US12345', 'US1%04d')
+        chunks = [[(i, line % i, i * 100)] for i in range(10)]
+        results = list(transform_pipeline(iter(chunks), 2, fieldnames, TRANSFORMER_ARGS))
+        self.assertEqual([offset for chunk, offset in results], [i * 100 for i in range(10)])
+        self.assertEqual([chunk[0][1] for chunk, offset in results], [10000 + i for i in range(10)])
+
+
+class LoadCertsTests(TestCase):
+
+    @mock.patch('kpc.management.commands.load_certs.build_country_map', return_value={})
+    def test_header_only(self, build_country_map):
+        """A file without records loads nothing, with no checkpoint to remove"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'certs.csv')
+            with open(path, 'w') as f:
+                f.write('ID,CertNumber,ImporterAddress\n')
+            out = io.StringIO()
+            call_command('load_certs', path, '--workers', '1', stdout=out)
+        self.assertIn('Processed 0 certificate records.', out.getvalue())
+
+
+@override_settings(EMAIL_QUEUE_MAX_ATTEMPTS=2, EMAIL_QUEUE_RETRY_DELAY=60)
+class SendQueuedEmailTests(TestCase):
+
+    def setUp(self):
+        self.email, = queue_email('Subject', 'text', '<p>html</p>', ['a@test.com'])
+
+    def test_queue_drained(self):
+        """Queued messages are delivered once with their HTML alternative"""
+        call_command('send_queued_email', stdout=io.StringIO())
+        call_command('send_queued_email', stdout=io.StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['a@test.com'])
+        self.assertEqual(mail.outbox[0].alternatives, [('<p>html</p>', 'text/html')])
+        self.email.refresh_from_db()
+        self.assertEqual(self.email.status, QueuedEmail.SENT)
+
+    @mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                side_effect=SMTPException('unavailable'))
+    def test_failure_backs_off(self, send_messages):
+        """Failed messages are retried later, then marked failed"""
+        call_command('send_queued_email', stdout=io.StringIO())
+        self.email.refresh_from_db()
+        self.assertEqual(self.email.status, QueuedEmail.PENDING)
+        self.assertEqual(self.email.attempts, 1)
+        self.assertEqual(self.email.last_error, 'unavailable')
+        self.assertGreater(self.email.next_attempt, timezone.now())
+
+        QueuedEmail.objects.update(next_attempt=timezone.now())
+        call_command('send_queued_email', stdout=io.StringIO())
+        self.email.refresh_from_db()
+        self.assertEqual(self.email.status, QueuedEmail.FAILED)
+        self.assertEqual(send_messages.call_count, 2)
+
+
+class VoidCertificatesTests(TestCase):
+
+    def setUp(self):
+        self.user = mommy.make(settings.AUTH_USER_MODEL, is_superuser=True)
+        for number in range(100, 103):
+            mommy.make(Certificate, number=number, status=Certificate.AVAILABLE)
+
+    def test_range_voided(self):
+        call_command('void_certificates', 'US100-US101', '--user', self.user.username,
+                     '--reason', 'Other', '--notes', 'Lost book', stdout=io.StringIO())
+        self.assertEqual(sorted(Certificate.objects.filter(void=True).values_list('number', flat=True)),
+                         [100, 101])
+        self.assertEqual(Certificate.history.filter(history_type='~', history_user=self.user).count(), 2)
+
+    def test_invalid_selection(self):
+        with self.assertRaises(CommandError):
+            call_command('void_certificates', 'US100-US110', '--user', self.user.username,
+                         '--reason', 'Other', '--notes', 'Lost book')
+        self.assertFalse(Certificate.objects.filter(void=True).exists())
@@ -2,16 +2,33 @@ import datetime
 
 from django import forms
 from django.conf import settings
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
 from model_mommy import mommy
 
 from kpc.forms import (CertificateRegisterForm, EditRequestForm,
                        EditRequestReviewForm, KpcAddressForm,
-                       LicenseeCertificateForm, StatusUpdateForm, VoidForm)
+                       KPCountryMatcher, LicenseeCertificateForm,
+                       StatusUpdateForm, VoidForm)
 from kpc.models import Certificate, CertificateConfig, EditRequest
 from kpc.tests import CERT_FORM_KWARGS
 
 
+class KPCountryMatcherTests(SimpleTestCase):
+
+    def setUp(self):
+        self.matcher = KPCountryMatcher(('NE', 'NG', 'AQ'))
+
+    def test_country_reported(self):
+        """The country named in an address is returned, regardless of case"""
+        self.assertEqual(self.matcher.match('1 Street\nLagos\nNIGERIA').code, 'NG')
+        self.assertEqual(self.matcher.match('1 Street, Niamey, Niger').code, 'NE')
+        self.assertEqual(self.matcher.match('Base Camp antarctica').code, 'AQ')
+
+    def test_no_country(self):
+        self.assertIsNone(self.matcher.match('1 Street, Paris, France'))
+
+
 class VoidFormTests(TestCase):
 
     def setUp(self):
@@ -206,6 +223,14 @@ class CertificateRegistrationTests(TestCase):
         form.is_valid()
         self.assertEqual(form.get_cert_list(), [1])
 
+    def test_ranges(self):
+        """Requested certificates are described by inclusive ranges"""
+        self._make_sequential(1, 50000)
+        self.form_kwargs['payment_amount'] = 50000 * 20
+        form = CertificateRegisterForm(self.form_kwargs)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.get_cert_ranges(), [(1, 50000)])
+
     def _make_sequential(self, start, end):
         self.form_kwargs.pop('cert_list')
         self.form_kwargs.update(
@@ -259,14 +284,14 @@ class LicenseeCertificateFormTests(TestCase):
         form = LicenseeCertificateForm()
         self.assertEqual(countries, form.fields['country_of_origin'].choices)
 
-    def test_address_book_options_rendered(self):
-        """Address book select options rendered if they exist for licensee"""
+    def test_address_book_linked(self):
+        """Address book entries are loaded on demand from the licensee's address book URL"""
         destination = mommy.make('KpcAddress')
         cert = mommy.prepare(Certificate, licensee=destination.licensee)
         form = LicenseeCertificateForm(instance=cert)
-        choice = (destination.id, destination.name)
-        self.assertIn(
-            choice, [choice for choice in form.fields['addresses'].choices])
+        self.assertEqual(form.address_book_url,
+                         reverse('licensee-addresses', args=[destination.licensee.id]))
+        self.assertNotIn('addresses', form.fields)
 
     def test_exporter_prepopulated(self):
         """Exporter and Exporter address fields are prepopulated with licensee's info"""
@@ -0,0 +1,77 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.template import Context
+from django.template.loader import render_to_string
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from model_mommy import mommy
+
+from kpc.mail import mail_engine, notify_reviewers, queue_reviewer_digest
+from kpc.models import Certificate, CertificateConfig, EditRequest, QueuedEmail
+
+
+class MailEngineTests(SimpleTestCase):
+
+    def test_templates_compiled_once(self):
+        """Mail templates are reused rather than loaded for each message"""
+        template = mail_engine().get_template('mail/edit_request_reviewed.html')
+        self.assertIs(mail_engine().get_template('mail/edit_request_reviewed.html'), template)
+
+    def test_matches_site_templates(self):
+        """Rendering matches the site template engine"""
+        edit_request = EditRequest(id=1, status=EditRequest.APPROVED,
+                                   certificate=Certificate(number=123456))
+        context = {'edit_request': edit_request}
+        name = 'mail/edit_request_reviewed_subject.txt'
+        subject = mail_engine().get_template(name).render(Context(context))
+        self.assertEqual(subject, render_to_string(name, context))
+        self.assertIn('US123456', subject)
+
+
+class ReviewerDigestTests(TestCase):
+
+    def setUp(self):
+        config = CertificateConfig.get_solo()
+        config.reviewer_digest = True
+        config.save()
+        group = Group.objects.get_or_create(name='Reviewer')[0]
+        for email in ['reviewer1@test.com', 'reviewer2@test.com']:
+            mommy.make(settings.AUTH_USER_MODEL, email=email).groups.add(group)
+        self.edit_requests = [
+            mommy.make('EditRequest', certificate__licensee=mommy.make('Licensee', name=name),
+                       status=EditRequest.PENDING, consignee='NEW')
+            for name in ['Licensee A', 'Licensee B']]
+
+    def test_no_immediate_notification(self):
+        """Submissions are left for the digest"""
+        notify_reviewers(RequestFactory().get('/'), self.edit_requests[0])
+        self.assertFalse(QueuedEmail.objects.exists())
+
+    def test_digest_per_reviewer(self):
+        """Each reviewer is queued one summary linking every new request"""
+        self.assertEqual(queue_reviewer_digest('https://example.com'), 2)
+        emails = QueuedEmail.objects.all()
+        self.assertCountEqual([email.to for email in emails],
+                              [['reviewer1@test.com'], ['reviewer2@test.com']])
+        for edit_request in self.edit_requests:
+            self.assertIn(f'https://example.com{edit_request.get_absolute_url()}', emails[0].body)
+            self.assertIn(edit_request.certificate.licensee.name, emails[0].html)
+
+    def test_only_new_requests(self):
+        """Requests included in a previous digest, or no longer pending, are skipped"""
+        queue_reviewer_digest()
+        self.assertEqual(queue_reviewer_digest(), 0)
+        new_request = mommy.make('EditRequest', status=EditRequest.PENDING, consignee='NEW')
+        mommy.make('EditRequest', status=EditRequest.APPROVED, consignee='NEW')
+        self.assertEqual(queue_reviewer_digest(), 1)
+        self.assertIn(new_request.get_absolute_url(), QueuedEmail.objects.last().body)
+
+    def test_late_commit_included(self):
+        """A request committed after a digest, but dated before it, joins the next digest"""
+        queue_reviewer_digest()
+        late_request = mommy.make('EditRequest', status=EditRequest.PENDING, consignee='NEW')
+        EditRequest.objects.filter(pk=late_request.pk).update(
+            date_requested=CertificateConfig.get_solo().last_reviewer_digest - timedelta(minutes=1))
+        self.assertEqual(queue_reviewer_digest(), 1)
+        self.assertIn(late_request.get_absolute_url(), QueuedEmail.objects.last().body)
@@ -1,15 +1,52 @@
+import itertools
+import threading
 from datetime import datetime
+from decimal import Decimal
 
 from django.conf import settings
 from django.contrib.auth.models import Group
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from model_mommy import mommy
 
-from kpc.models import Certificate, Licensee
+from kpc.bulk import register_certificates
+from kpc.history import buffered_history, record_history
+from kpc.models import (Certificate, CertificateConfig, EditRequest, Licensee,
+                        NumberAllocator, Receipt)
 from kpc.tests import load_initial_data
 
 
+class CertificateConfigCacheTests(TransactionTestCase):
+
+    def setUp(self):
+        CertificateConfig.invalidate_cache()
+
+    def tearDown(self):
+        CertificateConfig.invalidate_cache()
+
+    def test_config_reused(self):
+        """Committed configuration is read from the database once"""
+        CertificateConfig.get_solo()
+        with self.assertNumQueries(0):
+            CertificateConfig.get_solo()
+
+    def test_save_invalidates(self):
+        """Saved changes are visible on the next read"""
+        config = CertificateConfig.get_solo()
+        config.price = Decimal('30.00')
+        config.save()
+        self.assertEqual(CertificateConfig.get_solo().price, Decimal('30.00'))
+
+    def test_version_change_reloads(self):
+        """Changes saved by another worker are picked up"""
+        CertificateConfig.get_solo()
+        CertificateConfig._version_cache().set(CertificateConfig.CACHE_VERSION_KEY, 'other-worker', None)
+        with self.assertNumQueries(1):
+            CertificateConfig.get_solo()
+
+
 class LicenseeTests(TestCase):
 
     def setUp(self):
@@ -149,6 +186,21 @@ class CertificateTests(TestCase):
         self.cert.status = Certificate.PREPARED
         self.assertEqual(self.cert.next_status_value, Certificate.SHIPPED)
 
+    def test_edit_state_fetched_in_bulk(self):
+        """Pending edits and the edit request flag cost a fixed number of queries"""
+        config = CertificateConfig.get_solo()
+        config.edit_requests = True
+        config.save()
+        others = mommy.make(Certificate, _quantity=3)
+        edit = mommy.make(EditRequest, certificate=self.cert)
+        mommy.make(EditRequest, certificate=others[0], status=EditRequest.APPROVED)
+
+        # configuration, certificates, pending edit requests
+        with self.assertNumQueries(3):
+            certs = list(Certificate.objects.with_edit_state().order_by('number'))
+            self.assertEqual([c.pending_edit for c in certs], [edit, None, None, None])
+            self.assertEqual([c.show_edit_link for c in certs], [False, True, True, True])
+
 
 class ReceiptTests(TestCase):
 
@@ -173,6 +225,130 @@ class ReceiptTests(TestCase):
         receipt.refresh_from_db()
         self.assertEqual(receipt.number, settings.LAST_RECEIPT_NUMBER)
 
+    def test_receipt_number_follows_existing_receipts(self):
+        """Allocation continues after receipts numbered before the allocator existed"""
+        Receipt.objects.bulk_create([mommy.prepare('Receipt', number=2000)])
+        self.assertEqual(mommy.make('Receipt').number, 2001)
+
+
+class NumberAllocationTests(TransactionTestCase):
+    """Numbers allocated by concurrent transactions are unique and contiguous"""
+
+    THREADS = 8
+    ALLOCATIONS = 10
+
+    def run_concurrently(self, allocate):
+        results = []
+        start = threading.Barrier(self.THREADS)
+
+        def worker():
+            try:
+                start.wait()
+                for _ in range(self.ALLOCATIONS):
+                    with transaction.atomic():
+                        results.append(allocate())
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_receipts(self):
+        numbers = self.run_concurrently(lambda: mommy.make('Receipt').number)
+        first = settings.LAST_RECEIPT_NUMBER
+        self.assertEqual(sorted(numbers), list(range(first, first + self.THREADS * self.ALLOCATIONS)))
+
+    def test_concurrent_certificate_registration(self):
+        """Blocks registered concurrently advance the series past the highest number"""
+        mommy.make(Certificate, number=100)
+        blocks = itertools.count()
+        licensee = mommy.make('Licensee')
+
+        def register():
+            low = 101 + next(blocks) * 50
+            return register_certificates([(low, low + 49)], licensee=licensee,
+                                         last_modified=datetime.now())
+
+        self.run_concurrently(register)
+        last = 100 + self.THREADS * self.ALLOCATIONS * 50
+        self.assertEqual(sorted(Certificate.objects.values_list('number', flat=True)),
+                         list(range(100, last + 1)))
+        self.assertEqual(NumberAllocator.peek(NumberAllocator.CERTIFICATE), last + 1)
+        self.assertEqual(Certificate.next_available_number(), last + 1)
+
+    def test_rolled_back_numbers_reused(self):
+        with transaction.atomic():
+            first = NumberAllocator.reserve('test')
+            transaction.set_rollback(True)
+        self.assertEqual(NumberAllocator.reserve('test'), first)
+
+
+class BufferedHistoryTests(TestCase):
+
+    def setUp(self):
+        self.user = mommy.make(settings.AUTH_USER_MODEL)
+
+    def test_records_written_on_completion(self):
+        """Historical records are held back until the block completes"""
+        with buffered_history():
+            cert = mommy.make(Certificate)
+            cert.save()
+            self.assertFalse(Certificate.history.exists())
+        self.assertEqual(list(Certificate.history.values_list('history_type', flat=True)
+                              .order_by('history_id')), ['+', '~'])
+
+    def test_one_insert_per_history_model(self):
+        licensee = mommy.make(Licensee)
+        certs = [mommy.make(Certificate, licensee=licensee) for _ in range(3)]
+        table = Certificate.history.model._meta.db_table
+        with CaptureQueriesContext(connection) as queries:
+            with buffered_history():
+                for cert in certs:
+                    cert.save()
+        inserts = [query for query in queries.captured_queries
+                   if query['sql'].startswith(f'INSERT INTO "{table}"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(Certificate.history.filter(history_type='~').count(), 3)
+
+    def test_failed_nested_block_discarded(self):
+        with buffered_history():
+            mommy.make(Certificate, number=1)
+            try:
+                with buffered_history():
+                    mommy.make(Certificate, number=2)
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(list(Certificate.history.values_list('number', flat=True)), [1])
+
+    def test_rolled_back_savepoint_discarded(self):
+        """Records from a plain savepoint which rolls back are not written"""
+        with buffered_history():
+            cert = mommy.make(Certificate, number=1)
+            try:
+                with transaction.atomic():
+                    cert.consignee = 'ROLLED BACK'
+                    cert.save()
+                    record_history([mommy.make(Certificate, number=2)], history_type='~')
+                    raise ValueError
+            except ValueError:
+                pass
+            cert.refresh_from_db()
+        self.assertEqual(list(Certificate.history.values_list('number', 'history_type', 'consignee')),
+                         [(1, '+', cert.consignee)])
+
+    def test_record_history(self):
+        """Instances saved without signals have history recorded explicitly"""
+        certs = Certificate.objects.bulk_create([Certificate(number=number, last_modified=datetime.now())
+                                                 for number in (1, 2)])
+        record_history(certs, history_type='+', history_user=self.user)
+        self.assertEqual(Certificate.history.filter(history_type='+', history_user=self.user).count(), 2)
+        self.assertEqual(Certificate.history.get(number=1).id, certs[0].id)
+
 
 class EditRequestTests(TestCase):
 
@@ -199,3 +375,13 @@ class EditRequestTests(TestCase):
         self.edit.approve()
         self.cert.refresh_from_db()
         self.assertEquals(self.cert.consignee, self.edit.consignee)
+
+    def test_certificate_snapshot(self):
+        """Certificate values are stored with the request and used without history queries"""
+        edit = mommy.make('EditRequest', certificate=self.cert, consignee='NEW')
+        self.cert.consignee = 'LATER'
+        self.cert.save()
+        edit = EditRequest.objects.select_related('certificate').get(pk=edit.pk)
+        with self.assertNumQueries(0):
+            changes = list(edit.changed_fields_display())
+        self.assertEqual(changes, [('consignee', 'CURRENT', 'NEW')])
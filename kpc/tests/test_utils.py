@@ -1,7 +1,14 @@
-from django.test import SimpleTestCase
+import io
+
+from django.test import SimpleTestCase, override_settings
 from django.http.request import QueryDict
+from PyPDF2 import PdfFileReader
 
-from kpc.utils import _filterable_params
+from kpc.management.commands.benchmark_preview import sample_certificate
+from kpc.utils import (MAX_CERTIFICATE_NUMBER, CertificatePreview,
+                       _filterable_params, collapse_numbers, collapse_ranges,
+                       number_list_ranges, number_search_ranges,
+                       render_certificates)
 
 
 class UtilTests(SimpleTestCase):
@@ -12,3 +19,108 @@ class UtilTests(SimpleTestCase):
         processed = _filterable_params(raw)
         for key in processed.keys():
             self.assertFalse(key.endswith('[]'))
+
+
+class NumberSearchTests(SimpleTestCase):
+
+    def test_prefix(self):
+        """Prefixes become ranges of each longer number beginning with them"""
+        ranges = number_search_ranges('US2147')
+        self.assertEqual(ranges[:3], [(2147, 2147), (21470, 21479), (214700, 214799)])
+        self.assertEqual(ranges[-1], (2147000000, MAX_CERTIFICATE_NUMBER))
+        self.assertEqual(number_search_ranges('us2147'), ranges)
+        self.assertEqual(number_search_ranges('2147'), ranges)
+
+    def test_range(self):
+        self.assertEqual(number_search_ranges('US1000-US2000'), [(1000, 2000)])
+        self.assertEqual(number_search_ranges('2000 - 1000'), [(1000, 2000)])
+
+    def test_list(self):
+        """Comma separated terms are combined"""
+        self.assertEqual(number_search_ranges('US1000-US1005, 1000000000'),
+                         [(1000, 1005), (1000000000, 1000000000)])
+
+    def test_list_of_numbers_exact(self):
+        """Numbers listed together are not treated as prefixes"""
+        self.assertEqual(number_search_ranges('US12345, US12346'), [(12345, 12345), (12346, 12346)])
+
+    def test_unrecognized(self):
+        for search in ['abc', 'US', '1-', 'US12X', ',']:
+            self.assertIsNone(number_search_ranges(search), search)
+
+    def test_collapse_numbers(self):
+        """Consecutive numbers are collapsed into ranges, duplicates ignored"""
+        self.assertEqual(collapse_numbers([7, 1, 2, 3, 3, 10, 8]), [(1, 3), (7, 8), (10, 10)])
+        self.assertEqual(collapse_numbers([]), [])
+
+    def test_collapse_ranges(self):
+        self.assertEqual(collapse_ranges([(5, 10), (1, 3), (4, 4), (8, 12), (20, 21)]),
+                         [(1, 12), (20, 21)])
+
+    def test_number_list(self):
+        """Exact numbers and ranges, not prefixes"""
+        self.assertEqual(number_list_ranges('US1000-US1005, 2000\nus3000'),
+                         [(1000, 1005), (2000, 2000), (3000, 3000)])
+        self.assertIsNone(number_list_ranges('US1000-'))
+        self.assertIsNone(number_list_ranges(' , '))
+
+
+class CertificatePreviewTests(SimpleTestCase):
+
+    def setUp(self):
+        CertificatePreview.clear_cache()
+        self.cert = sample_certificate()
+
+    def test_base_page_parsed_once(self):
+        """Base certificate page is reused across previews"""
+        CertificatePreview(self.cert).make_preview()
+        base_page = CertificatePreview.get_base_page()
+        CertificatePreview(self.cert).make_preview()
+        self.assertIs(CertificatePreview.get_base_page(), base_page)
+
+    def test_base_page_unmodified(self):
+        """Rendering does not draw onto the cached base page"""
+        base_page = CertificatePreview.get_base_page()
+        contents = base_page.getContents().getData()
+        CertificatePreview(self.cert).render()
+        self.assertEqual(base_page.getContents().getData(), contents)
+
+    def test_each_preview_contains_own_values(self):
+        """Consecutive previews contain their own certificate's values only"""
+        for number in (111111, 222222):
+            self.cert.number = number
+            page = PdfFileReader(io.BytesIO(CertificatePreview(self.cert).render())).getPage(0)
+            text = page.extractText()
+            self.assertIn(str(number), text)
+            self.assertIn('/XObject', page['/Resources'])
+
+
+class RenderCertificatesTests(SimpleTestCase):
+
+    def setUp(self):
+        self.certs = []
+        for number in range(1, 4):
+            cert = sample_certificate()
+            cert.number = number
+            self.certs.append(cert)
+
+    def _render(self, processes):
+        output = io.BytesIO()
+        count = render_certificates(self.certs, output, processes=processes)
+        self.assertEqual(count, len(self.certs))
+        return PdfFileReader(output)
+
+    def test_one_page_per_certificate(self):
+        """Each certificate is rendered on its own page, in order"""
+        pdf = self._render(processes=1)
+        self.assertEqual(pdf.getNumPages(), 3)
+        for i, cert in enumerate(self.certs):
+            self.assertIn(f'{cert.number}', pdf.getPage(i).extractText())
+
+    @override_settings(CERTIFICATE_BATCH_PROCESS_THRESHOLD=2)
+    def test_process_pool_rendering(self):
+        """Large batches render in worker processes with the same result"""
+        pdf = self._render(processes=2)
+        self.assertEqual(pdf.getNumPages(), 3)
+        for i, cert in enumerate(self.certs):
+            self.assertIn(f'{cert.number}', pdf.getPage(i).extractText())
@@ -1,20 +1,32 @@
 import datetime
+import io
 import json
+from unittest import mock
 
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, Group, Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
-from django.test import Client, RequestFactory, SimpleTestCase, TestCase
+from django.db.models import Q
+from django.test import (Client, RequestFactory, SimpleTestCase, TestCase,
+                         override_settings)
 from django.urls import reverse
 from model_mommy import mommy
 from django.core import mail
-
-from kpc.forms import LicenseeCertificateForm, StatusUpdateForm
-from kpc.models import Certificate, CertificateConfig, EditRequest, Receipt
+from PyPDF2 import PdfFileReader
+
+from kpc.filters import filter_panel
+from kpc.forms import (BulkStatusUpdateForm, BulkVoidForm,
+                       LicenseeCertificateForm, StatusUpdateForm)
+from kpc.mail import send_queued_email
+from kpc.management.commands.benchmark_preview import sample_certificate
+from kpc.models import (Certificate, CertificateConfig, CertificateStatistic,
+                        EditRequest, QueuedEmail, Receipt)
 from kpc.tests import CERT_FORM_KWARGS, load_initial_data
-from kpc.views import (CertificateRegisterView, CertificateView,
+from kpc.views import (CertificateJson, CertificatePrintView,
+                       CertificateRegisterView, CertificateView,
                        CertificateVoidView, ExportView, licensee_contacts)
 
 
@@ -169,6 +181,32 @@ class CertificateRegisterViewTests(TestCase):
         success_msg = CertificateRegisterView.get_success_msg(5, receipt)
         self.assertEqual(message.message, success_msg)
 
+    def test_registration_history(self):
+        """Registered certificates have a created history record by the registering user"""
+        client = Client()
+        client.force_login(self.admin_user)
+        self.form_kwargs.update(self.sequential_kwargs)
+
+        client.post(reverse('cert-register'), self.form_kwargs)
+        history = Certificate.history.all()
+        self.assertEqual(sorted(h.number for h in history), [1, 2, 3, 4, 5])
+        self.assertTrue(all(h.history_type == '+' and h.history_user == self.admin_user
+                            for h in history))
+
+    def test_conflicting_registration(self):
+        """Numbers registered after validation are reported without creating any certificates"""
+        client = Client()
+        client.force_login(self.admin_user)
+        self.form_kwargs.update(self.sequential_kwargs)
+
+        mommy.make(Certificate, number=3)
+        # the conflict is not seen by form validation
+        with mock.patch('kpc.forms.number_ranges_q', return_value=Q(pk__in=[])):
+            response = client.post(reverse('cert-register'), self.form_kwargs)
+        self.assertContains(response, CertificateRegisterView.CONFLICT)
+        self.assertEqual(Certificate.objects.count(), 1)
+        self.assertFalse(Receipt.objects.exists())
+
     def test_list_generation(self):
         """
         Generate certs parsed from CERT_LIST
@@ -354,6 +392,153 @@ class CertificateListViewTests(TestCase):
         self.assertRedirects(response, target_url,
                              fetch_redirect_response=False)
 
+    def test_filter_panel_cached(self):
+        """Filter choices are not queried again until they change"""
+        cache.clear()
+        user = mommy.make(settings.AUTH_USER_MODEL, is_superuser=True)
+        self.c.force_login(user)
+        mommy.make('Licensee', name='FIRST LICENSEE')
+        self.assertContains(self.c.get(self.url), 'FIRST LICENSEE')
+
+        request = self.c.get(self.url).wsgi_request
+        with self.assertNumQueries(0):
+            filter_panel(request)
+
+        mommy.make('Licensee', name='SECOND LICENSEE')
+        self.assertContains(self.c.get(self.url), 'SECOND LICENSEE')
+
+    def test_list_rendered_with_filters(self):
+        """Cached choices render, with the current search selected"""
+        cache.clear()
+        licensee = mommy.make('Licensee', name='SELECTED LICENSEE')
+        user = mommy.make(settings.AUTH_USER_MODEL, is_superuser=True)
+        self.c.force_login(user)
+        for _ in range(2):
+            response = self.c.get(self.url, {'licensee__name': licensee.id})
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, f'<option value="{licensee.id}" selected>SELECTED LICENSEE</option>',
+                                html=True)
+
+    def test_filter_panel_per_licensee_set(self):
+        """Contacts are only offered their own licensees"""
+        cache.clear()
+        licensee = mommy.make('Licensee', name='OWN LICENSEE')
+        mommy.make('Licensee', name='OTHER')
+        user = mommy.make(settings.AUTH_USER_MODEL, is_superuser=True)
+        self.c.force_login(user)
+        self.assertContains(self.c.get(self.url), 'OTHER')
+
+        contact = mommy.make(settings.AUTH_USER_MODEL)
+        contact.profile.licensees.add(licensee)
+        self.c.force_login(contact)
+        response = self.c.get(self.url)
+        self.assertContains(response, 'OWN LICENSEE')
+        self.assertNotContains(response, 'OTHER')
+
+
+class CertificateStatusUpdateViewTests(TestCase):
+
+    def setUp(self):
+        self.licensee = mommy.make('Licensee')
+        self.user = mommy.make(settings.AUTH_USER_MODEL)
+        self.user.profile.licensees.add(self.licensee)
+        self.certs = [mommy.make(Certificate, number=number, licensee=self.licensee,
+                                 status=Certificate.PREPARED, date_of_issue=datetime.date(2018, 1, 1))
+                      for number in range(100, 105)]
+        self.c = Client()
+        self.c.force_login(self.user)
+        self.url = reverse('bulk-status')
+        self.data = {'numbers': 'US100-US103', 'next_status': Certificate.SHIPPED,
+                     'date': '2018-01-05'}
+
+    def test_auditors_denied(self):
+        self.c.force_login(make_auditor())
+        self.assertEqual(self.c.get(self.url).status_code, 403)
+
+    def test_numbers_shipped(self):
+        """Listed certificates are shipped together with history recorded"""
+        self.c.post(self.url, self.data)
+        shipped = Certificate.objects.filter(status=Certificate.SHIPPED)
+        self.assertEqual(sorted(shipped.values_list('number', flat=True)), [100, 101, 102, 103])
+        self.assertTrue(all(cert.date_of_shipment == datetime.date(2018, 1, 5) for cert in shipped))
+        history = Certificate.history.filter(history_type='~')
+        self.assertEqual(history.count(), 4)
+        self.assertTrue(all(h.status == Certificate.SHIPPED and h.history_user == self.user
+                            for h in history))
+
+    def test_search_shipped(self):
+        """Without numbers, certificates matching the search are updated"""
+        self.data.pop('numbers')
+        self.c.post(self.url + '?search[value]=US10', self.data)
+        self.assertEqual(Certificate.objects.filter(status=Certificate.SHIPPED).count(), 5)
+
+    def test_validated_together(self):
+        """One invalid certificate prevents the update, and is reported"""
+        self.certs[2].date_of_issue = datetime.date(2018, 2, 1)
+        self.certs[2].save()
+        response = self.c.post(self.url, self.data)
+        self.assertContains(response, BulkStatusUpdateForm.SHIPPED_DATE % 'US102')
+        self.assertFalse(Certificate.objects.filter(status=Certificate.SHIPPED).exists())
+
+    def test_status_must_precede(self):
+        self.data['next_status'] = Certificate.DELIVERED
+        response = self.c.post(self.url, self.data)
+        self.assertContains(response, 'US100, US101, US102, US103')
+        self.assertFalse(Certificate.objects.filter(status=Certificate.DELIVERED).exists())
+
+    def test_inaccessible_certificates_not_found(self):
+        mommy.make(Certificate, number=99, status=Certificate.PREPARED)
+        self.data['numbers'] = 'US99-US100'
+        response = self.c.post(self.url, self.data)
+        self.assertContains(response, BulkStatusUpdateForm.NOT_FOUND % 1)
+
+
+class CertificateBulkVoidViewTests(TestCase):
+
+    def setUp(self):
+        self.licensee = mommy.make('Licensee')
+        self.user = mommy.make(settings.AUTH_USER_MODEL)
+        self.user.profile.licensees.add(self.licensee)
+        for number in range(100, 105):
+            mommy.make(Certificate, number=number, licensee=self.licensee, status=Certificate.AVAILABLE)
+        self.c = Client()
+        self.c.force_login(self.user)
+        self.url = reverse('bulk-void')
+        self.data = {'numbers': 'US100-US103', 'reason': 'Other', 'notes': 'Lost book', 'void': True}
+
+    def test_auditors_denied(self):
+        self.c.force_login(make_auditor())
+        self.assertEqual(self.c.get(self.url).status_code, 403)
+
+    def test_numbers_voided(self):
+        """Listed certificates are voided together with history recorded"""
+        self.c.post(self.url, self.data)
+        voided = Certificate.objects.filter(void=True, status=Certificate.VOID, notes='Lost book',
+                                            date_voided=datetime.date.today())
+        self.assertEqual(sorted(voided.values_list('number', flat=True)), [100, 101, 102, 103])
+        history = Certificate.history.filter(history_type='~')
+        self.assertEqual(history.count(), 4)
+        self.assertTrue(all(h.void and h.history_user == self.user for h in history))
+
+    def test_already_void_skipped(self):
+        """Certificates already voided keep their notes"""
+        Certificate.objects.filter(number=100).update(void=True, notes='Damaged')
+        response = self.c.post(self.url, self.data, follow=True)
+        self.assertContains(response, BulkVoidForm.SUCCESS_MSG % 3)
+        self.assertEqual(Certificate.objects.get(number=100).notes, 'Damaged')
+
+    def test_confirmation_required(self):
+        self.data.pop('void')
+        self.c.post(self.url, self.data)
+        self.assertFalse(Certificate.objects.filter(void=True).exists())
+
+    def test_inaccessible_certificates_not_found(self):
+        mommy.make(Certificate, number=99)
+        self.data['numbers'] = 'US99-US100'
+        response = self.c.post(self.url, self.data)
+        self.assertContains(response, BulkVoidForm.NOT_FOUND % 1)
+        self.assertFalse(Certificate.objects.filter(void=True).exists())
+
 
 class CertificateVoidTests(TestCase):
 
@@ -418,6 +603,58 @@ class ExportViewTests(TestCase):
         results = [row for row in response.streaming_content]
         self.assertEqual(len(results), 2 + Certificate.objects.count())
 
+    def test_rows_serialized(self):
+        """Rows are formatted with the export serializers"""
+        self.c.force_login(self.super_user)
+        self.cert.date_of_issue = datetime.date(2018, 1, 2)
+        self.cert.save()
+        response = self.c.get(self.url)
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn(f'{self.cert.display_name},', content)
+        self.assertIn('01/02/2018', content)
+
+
+class CertificatePrintViewTests(TestCase):
+
+    def setUp(self):
+        self.user = mommy.make(settings.AUTH_USER_MODEL, is_superuser=True)
+        self.c = Client()
+        self.c.force_login(self.user)
+        self.url = reverse('print')
+
+    def _make_prepared(self, number):
+        cert = sample_certificate()
+        cert.number = number
+        cert.harmonized_code = mommy.make('HSCode')
+        cert.status = Certificate.PREPARED
+        cert.save()
+        return cert
+
+    def test_pdf_of_prepared_certificates(self):
+        """Prepared certificates are returned as a single PDF"""
+        self._make_prepared(1)
+        self._make_prepared(2)
+        mommy.make(Certificate, number=3, status=Certificate.AVAILABLE)
+        response = self.c.get(self.url)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        pdf = PdfFileReader(io.BytesIO(response.content))
+        self.assertEqual(pdf.getNumPages(), 2)
+
+    def test_404_if_nothing_to_print(self):
+        """No prepared certificates matching search"""
+        mommy.make(Certificate, status=Certificate.AVAILABLE)
+        response = self.c.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(CERTIFICATE_BATCH_LIMIT=1)
+    def test_redirect_if_too_many(self):
+        """Users are asked to narrow search when over the batch limit"""
+        self._make_prepared(1)
+        self._make_prepared(2)
+        response = self.c.get(self.url, follow=True)
+        message = list(response.context['messages']).pop()
+        self.assertEqual(message.message, CertificatePrintView.TOO_MANY % 1)
+
 
 class LicenseeDetailsViewTests(TestCase):
 
@@ -492,6 +729,114 @@ class CertificateJsonTests(SimpleTestCase):
         self.assertTrue(physical_fields.issubset(returned_columns))
 
 
+class CertificateJsonPagingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = mommy.make(settings.AUTH_USER_MODEL, is_superuser=True)
+        self.c = Client()
+        self.c.force_login(self.user)
+        self.url = reverse('certificate-data')
+        for number, value in enumerate([30, None, 10, 30, 20, None], start=1):
+            mommy.make(Certificate, number=number, shipped_value=value)
+        self.value_column = CertificateJson.columns.index('shipped_value')
+
+    def _get_page(self, start, length=2, direction='asc'):
+        params = {'start': start, 'length': length,
+                  'order[0][column]': self.value_column, 'order[0][dir]': direction}
+        response = self.c.get(self.url, params)
+        return [row['number'] for row in json.loads(response.content)['data']]
+
+    def _expected(self, direction='asc'):
+        prefix = '-' if direction == 'desc' else ''
+        ordered = Certificate.objects.order_by(f'{prefix}shipped_value', f'{prefix}number')
+        return list(ordered.values_list('number', flat=True))
+
+    def test_pages_follow_bookmarks_in_order(self):
+        """Sequential pages seek from the previous page's last row"""
+        for direction in ['asc', 'desc']:
+            numbers = []
+            for start in range(0, 6, 2):
+                numbers += self._get_page(start, direction=direction)
+            self.assertEqual(numbers, self._expected(direction))
+
+    def test_page_without_bookmark_served_from_end(self):
+        """Pages requested out of sequence are still returned in order"""
+        self.assertEqual(self._get_page(4), self._expected()[4:])
+
+    def test_counts_returned(self):
+        """Total and filtered counts are returned"""
+        response = self.c.get(self.url, {'start': 0, 'length': 2, 'status': Certificate.VOID})
+        content = json.loads(response.content)
+        self.assertEqual(content['recordsTotal'], 6)
+        self.assertEqual(content['recordsFiltered'], 0)
+
+    def test_number_search(self):
+        """Certificate number search accepts prefixes, ranges and lists of exact numbers"""
+        mommy.make(Certificate, number=12)
+        response = self.c.get(self.url, {'start': 0, 'length': 10, 'search[value]': 'US1, US3-US5'})
+        numbers = [row['number'] for row in json.loads(response.content)['data']]
+        self.assertEqual(numbers, [1, 3, 4, 5])
+        response = self.c.get(self.url, {'start': 0, 'length': 10, 'search[value]': 'US1'})
+        numbers = [row['number'] for row in json.loads(response.content)['data']]
+        self.assertEqual(numbers, [1, 12])
+
+    def test_text_search_matches_any_party_field(self):
+        """Free text search matches exporter, consignee and their addresses"""
+        mommy.make(Certificate, number=7, consignee='Acme Gems')
+        mommy.make(Certificate, number=8, exporter_address='1 ACME Way')
+        response = self.c.get(self.url, {'start': 0, 'length': 10, 'text': 'acme'})
+        numbers = [row['number'] for row in json.loads(response.content)['data']]
+        self.assertEqual(numbers, [7, 8])
+
+
+class CertificateStatisticsTests(TestCase):
+
+    def setUp(self):
+        self.c = Client()
+
+    def test_contacts_denied(self):
+        """Statistics span all licensees, contacts may not view them"""
+        self.c.force_login(mommy.make(settings.AUTH_USER_MODEL))
+        self.assertEqual(self.c.get(reverse('statistics')).status_code, 403)
+        self.assertEqual(self.c.get(reverse('statistics-data')).status_code, 403)
+
+    def test_statistics_grouped(self):
+        """Totals are returned for each requested grouping"""
+        licensee = mommy.make('Licensee')
+        mommy.make(Certificate, licensee=licensee, status=Certificate.SHIPPED, shipped_value=10, _quantity=2)
+        mommy.make(Certificate, licensee=licensee, status=Certificate.VOID)
+        CertificateStatistic.refresh()
+
+        self.c.force_login(make_auditor())
+        response = self.c.get(reverse('statistics-data'), {'group_by': ['licensee', 'status']})
+        results = json.loads(response.content)['results']
+        self.assertEqual(results, [
+            {'licensee': licensee.name, 'status': 'Shipped', 'certificates': 2,
+             'shipped_value': '20.00', 'carat_weight': None},
+            {'licensee': licensee.name, 'status': 'Void', 'certificates': 1,
+             'shipped_value': None, 'carat_weight': None},
+        ])
+
+    def test_invalid_grouping(self):
+        self.c.force_login(make_auditor())
+        response = self.c.get(reverse('statistics-data'), {'group_by': 'color'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_stale_after_delete(self):
+        """Deleted certificates make statistics stale, as do new ones"""
+        certificate = mommy.make(Certificate, status=Certificate.VOID)
+        self.assertTrue(CertificateStatistic.is_stale())
+        CertificateStatistic.refresh()
+        self.assertIsNotNone(CertificateStatistic.refreshed())
+        self.assertFalse(CertificateStatistic.is_stale())
+
+        certificate.delete()
+        self.assertTrue(CertificateStatistic.is_stale())
+        CertificateStatistic.refresh()
+        self.assertFalse(CertificateStatistic.objects.exists())
+
+
 def make_auditor():
     load_initial_data()
     user = mommy.make(settings.AUTH_USER_MODEL, is_superuser=False)
@@ -543,6 +888,43 @@ class KpcAddressCreateTests(TestCase):
         self.assertEqual(1, self.licensee.addresses.count())
 
 
+@override_settings(ADDRESS_BOOK_PAGE_SIZE=2)
+class KpcAddressJsonTests(TestCase):
+
+    def setUp(self):
+        self.licensee = mommy.make('Licensee')
+        for name in ['Alpha', 'Alpine', 'Beta', 'Gamma']:
+            mommy.make('KpcAddress', licensee=self.licensee, name=name, country='IN')
+        mommy.make('KpcAddress', name='Also')
+        self.user = mommy.make(settings.AUTH_USER_MODEL)
+        self.user.profile.licensees.add(self.licensee)
+        self.url = reverse('licensee-addresses', args=[self.licensee.id])
+        self.c = Client()
+        self.c.force_login(self.user)
+
+    def _names(self, response):
+        return [address['name'] for address in response.json()['results']]
+
+    def test_other_licensees_denied(self):
+        self.user.profile.licensees.remove(self.licensee)
+        self.assertEqual(self.c.get(self.url).status_code, 403)
+
+    def test_paginated(self):
+        """Pages of the licensee's own addresses continue after the last name served"""
+        response = self.c.get(self.url)
+        self.assertEqual(self._names(response), ['Alpha', 'Alpine'])
+        self.assertEqual(response.json()['results'][0]['country'], 'India')
+        response = self.c.get(self.url, {'after': response.json()['next']})
+        self.assertEqual(self._names(response), ['Beta', 'Gamma'])
+        self.assertIsNone(response.json()['next'])
+
+    def test_name_prefix(self):
+        """Names beginning with the search, ignoring case"""
+        response = self.c.get(self.url, {'q': 'ALP'})
+        self.assertEqual(self._names(response), ['Alpha', 'Alpine'])
+        self.assertIsNone(response.json()['next'])
+
+
 class KpcAddressEditDeleteTests(TestCase):
 
     def setUp(self):
@@ -634,6 +1016,18 @@ class CertificateEditViewTests(CertEditTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(self.cert.pending_edit.contact, self.user)
 
+    def test_form_valid_change_queues_notification(self):
+        """Each reviewer's notification is queued rather than sent during the request"""
+        group = Group.objects.get_or_create(name='Reviewer')[0]
+        for email in ['reviewer1@test.com', 'reviewer2@test.com']:
+            mommy.make(settings.AUTH_USER_MODEL, email=email).groups.add(group)
+        form_kwargs = self._make_edit_form_kwargs()
+        form_kwargs['consignee'] = 'NEW CONSIGNEE'
+        self.c.post(self.url, form_kwargs)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertCountEqual([email.to for email in QueuedEmail.objects.all()],
+                              [['reviewer1@test.com'], ['reviewer2@test.com']])
+
 
 class EditRequestViewTests(CertEditTestCase):
 
@@ -684,6 +1078,8 @@ class EditRequestViewTests(CertEditTestCase):
     def test_approve(self):
         """Certificate modified, reviewer set, and notification generated"""
         self.c.post(self.url, {'approve': True})
+        self.assertEqual(len(mail.outbox), 0)
+        send_queued_email()
         self.assertEqual(len(mail.outbox), 1)
         self.edit.refresh_from_db()
         self.cert.refresh_from_db()
@@ -694,6 +1090,8 @@ class EditRequestViewTests(CertEditTestCase):
     def test_reject(self):
         """Certificate NOT, reviewer set, and notification generated"""
         self.c.post(self.url, {'reject': True})
+        self.assertEqual(len(mail.outbox), 0)
+        send_queued_email()
         self.assertEqual(len(mail.outbox), 1)
         self.edit.refresh_from_db()
         self.cert.refresh_from_db()
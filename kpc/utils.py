@@ -1,8 +1,15 @@
 import base64
+import csv
 import io
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
 from django.conf import settings
+from django.db.models import Q
 from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import ArrayObject, DictionaryObject, NameObject
+from PyPDF2.pdf import PageObject
 from reportlab.lib.pagesizes import landscape, letter
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.pdfgen import canvas
@@ -15,12 +22,115 @@ def apply_certificate_search(request, qs):
     """Apply incoming search criteria to base queryset"""
     search = request.GET.get('search[value]')
     if search:
-        qs = qs.filter(number__istartswith=search)
+        ranges = number_search_ranges(search)
+        if ranges is None:
+            return qs.none()
+        qs = qs.filter(number_ranges_q(ranges))
     qs = CertificateFilter(_filterable_params(
         request.GET), request=request, queryset=qs).qs
     return qs
 
 
+# Largest value of Certificate.number (PositiveIntegerField)
+MAX_CERTIFICATE_NUMBER = 2147483647
+_NUMBER_TERM = re.compile(r'^(?:US)?(\d+)$', re.IGNORECASE)
+
+
+def _parse_number(term):
+    match = _NUMBER_TERM.match(term.replace(' ', ''))
+    return match.group(1) if match else None
+
+
+def number_prefix_ranges(prefix):
+    """
+    Inclusive integer ranges covering every number whose digits begin with prefix
+    e.g. '12' -> (12, 12), (120, 129), (1200, 1299), ...
+    """
+    if prefix.startswith('0'):
+        return [(0, 0)] if int(prefix) == 0 else []
+    value, width = int(prefix), 1
+    ranges = []
+    while value * width <= MAX_CERTIFICATE_NUMBER:
+        ranges.append((value * width, min((value + 1) * width - 1, MAX_CERTIFICATE_NUMBER)))
+        width *= 10
+    return ranges
+
+
+def _term_ranges(term, prefix=False):
+    """
+    Inclusive integer ranges matched by a number or range of numbers,
+    a single number matches every number beginning with it if prefix.
+    Returns None if the term is unrecognized.
+    """
+    low, dash, high = term.partition('-')
+    low, high = _parse_number(low), _parse_number(high if dash else low)
+    if low is None or high is None:
+        return None
+    if prefix and not dash:
+        return number_prefix_ranges(low)
+    return [tuple(sorted([int(low), int(high)]))]
+
+
+def _terms_ranges(terms, prefix=False):
+    ranges = []
+    for term in terms:
+        term_ranges = _term_ranges(term, prefix)
+        if term_ranges is None:
+            return None
+        ranges += term_ranges
+    return ranges or None
+
+
+def number_search_ranges(search):
+    """
+    Parse certificate number search into inclusive integer ranges
+
+    Accepts comma separated terms, each one of:
+        a number, with or without 'US': 'US123', '123'
+        a range of numbers: 'US1000-US2000', '1000-2000'
+
+    A single number is a prefix matching every longer number beginning
+    with it, numbers in a list of terms are exact.
+    Returns None if any term is unrecognized.
+    """
+    terms = [term for term in search.split(',') if term.strip()]
+    return _terms_ranges(terms, prefix=len(terms) == 1)
+
+
+def number_list_ranges(text):
+    """
+    Parse a list of exact certificate numbers into inclusive integer ranges
+
+    Terms are separated by commas or new lines, each a number ('US123', '123')
+    or a range of numbers ('US1000-US2000'). Returns None if any term is unrecognized.
+    """
+    return _terms_ranges(term for term in re.split(r'[,\n]', text) if term.strip())
+
+
+def collapse_ranges(ranges):
+    """Merge overlapping or adjacent inclusive (low, high) ranges"""
+    merged = []
+    for low, high in sorted(ranges):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def collapse_numbers(numbers):
+    """Inclusive (low, high) ranges of consecutive values among numbers"""
+    return collapse_ranges((number, number) for number in numbers)
+
+
+def number_ranges_q(ranges):
+    """Q matching certificate numbers within any of the inclusive ranges"""
+    match = Q()
+    for low, high in ranges:
+        match |= Q(number__range=(low, high))
+    return match
+
+
 def _filterable_params(qd):
     """
        Remove '[]' from querydict keys.
@@ -39,6 +149,42 @@ def _to_mdy(dt):
     return dt.strftime("%m/%d/%Y")
 
 
+class _Echo(object):
+    """File-like object which returns written values instead of buffering them"""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(qs, field_serializer_map=None, chunk_size=None):
+    """
+    Yield CSV lines for a values() queryset
+
+    Rows are read through a PostgreSQL server-side (named) cursor,
+    chunk_size rows at a time, so memory use is independent of export size.
+    """
+    field_serializer_map = field_serializer_map or {}
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    field_names = list(qs.query.values_select)
+    verbose_names = {field.name: str(field.verbose_name) for field in qs.model._meta.fields}
+    writer = csv.writer(_Echo())
+
+    # BOM to support CSVs in MS Excel
+    yield '\ufeff'
+    yield writer.writerow([verbose_names.get(name, name) for name in field_names])
+
+    for record in qs.iterator(chunk_size=chunk_size):
+        row = []
+        for name in field_names:
+            value = record[name]
+            if value is None:
+                value = ''
+            elif name in field_serializer_map:
+                value = field_serializer_map[name](value)
+            row.append(value)
+        yield writer.writerow(row)
+
+
 class CertificatePreview(object):
     """PDF preview of given Certificate"""
     LINE_1 = 287
@@ -67,9 +213,41 @@ class CertificatePreview(object):
         'consignee_address': (300, LINE_3-5),
     }
 
+    # Parsed once per process, see get_base_page and get_styles
+    _base_page = None
+    _base_contents = None
+    _styles = None
+    # PyPDF2 rewrites references within the shared base page objects while writing
+    _write_lock = threading.Lock()
+
     def __init__(self, certificate):
         self.certificate = certificate
 
+    @classmethod
+    def get_base_page(cls):
+        """Blank certificate page, read and parsed once per process"""
+        if cls._base_page is None:
+            with open(cls.BASE_IMAGE, 'rb') as base_file:
+                base_page = PdfFileReader(io.BytesIO(base_file.read())).getPage(0)
+            # Base drawing wrapped in q/Q so it cannot alter the overlay's graphics state
+            cls._base_contents = PageObject._pushPopGS(base_page.getContents(), base_page.pdf)
+            cls._base_page = base_page
+        return cls._base_page
+
+    @classmethod
+    def get_styles(cls):
+        """ReportLab stylesheet, built once per process"""
+        if cls._styles is None:
+            cls._styles = getSampleStyleSheet()
+        return cls._styles
+
+    @classmethod
+    def clear_cache(cls):
+        """Discard parsed base page and stylesheet"""
+        cls._base_page = None
+        cls._base_contents = None
+        cls._styles = None
+
     def _get_draw_locations(self, field):
         coords = self.COORDINATES[field]
         if isinstance(coords, list):
@@ -88,12 +266,11 @@ class CertificatePreview(object):
             drawer(x, y, output)
 
     def format_country_of_origin(self, value):
-        return self.certificate.get_country_of_origin_display()
+        return value.name
 
     def _paragraph_address(self, field):
         """Convert incoming address into list of Paragraphs"""
-        styles = getSampleStyleSheet()
-        styleN = styles['Normal']
+        styleN = self.get_styles()['Normal']
         value = getattr(self.certificate, field)
         return [Paragraph(line, styleN) for line in value.split('\n')]
 
@@ -115,7 +292,12 @@ class CertificatePreview(object):
                               maxHeight=self.ADDRESS_FRAME_HEIGHT)
         address_frame.addFromList([inframe], self.canvas)
 
-    def make_preview(self):
+    def render_overlay(self):
+        """Return page containing only this certificate's field values"""
+        return PdfFileReader(io.BytesIO(self.render_overlay_pdf())).getPage(0)
+
+    def render_overlay_pdf(self):
+        """Return PDF bytes containing only this certificate's field values"""
         kpc_text = io.BytesIO()
 
         # write KPC text with Reportlab
@@ -139,22 +321,95 @@ class CertificatePreview(object):
         self._draw_address('exporter_address')
         self._draw_address('consignee_address')
         self.canvas.save()
+        return kpc_text.getvalue()
 
-        # render as PDF
-        kpc_text.seek(0)
-        new_pdf = PdfFileReader(kpc_text)
+    @staticmethod
+    def _merge_resources(base, overlay):
+        """Combined resource dictionary, None if any resource names conflict"""
+        merged = DictionaryObject()
+        for resource in set(base.keys()) | set(overlay.keys()):
+            if resource == '/ProcSet':
+                procsets = frozenset(base.get(resource, ArrayObject()).getObject()) | \
+                    frozenset(overlay.get(resource, ArrayObject()).getObject())
+                merged[NameObject(resource)] = ArrayObject(procsets)
+                continue
+            combined = DictionaryObject(base.get(resource, DictionaryObject()).getObject())
+            for name, value in overlay.get(resource, DictionaryObject()).getObject().items():
+                if name in combined:
+                    return None
+                combined[name] = value
+            merged[NameObject(resource)] = combined
+        return merged
 
-        # read base PDF
-        existing_pdf = PdfFileReader(open(self.BASE_IMAGE, "rb"))
-        output = PdfFileWriter()
+    @classmethod
+    def merge_with_base(cls, overlay):
+        """
+        Return a new page with overlay drawn over the cached base page
+
+        The overlay's content stream is appended as-is rather than being
+        parsed and rewritten by PyPDF2's mergePage, which is only needed
+        when resource names conflict.
+        The shared base page itself is left unmodified.
+        """
+        base_page = cls.get_base_page()
+        page = PageObject(base_page.pdf)
+        page.update(base_page)
+
+        resources = cls._merge_resources(base_page['/Resources'].getObject(),
+                                         overlay['/Resources'].getObject())
+        if resources is None:
+            page.mergePage(overlay)
+            return page
 
-        # add the "watermark" (which is our new text) on the base kpc pdf
-        page = existing_pdf.getPage(0)
-        page.mergePage(new_pdf.getPage(0))
-        output.addPage(page)
+        page[NameObject('/Resources')] = resources
+        page[NameObject('/Contents')] = ArrayObject([cls._base_contents, overlay['/Contents']])
+        return page
 
-        # return base64 string for rendering in template
+    def render(self):
+        """Return certificate as PDF bytes"""
+        overlay = self.render_overlay()
         pdf_out = io.BytesIO()
-        output.write(pdf_out)
-        b64_out = base64.b64encode(pdf_out.getvalue()).decode()
-        return b64_out
+        with self._write_lock:
+            output = PdfFileWriter()
+            output.addPage(self.merge_with_base(overlay))
+            output.write(pdf_out)
+        return pdf_out.getvalue()
+
+    def make_preview(self):
+        """return base64 string for rendering in template"""
+        return base64.b64encode(self.render()).decode()
+
+
+def _render_overlay_pdf(certificate):
+    return CertificatePreview(certificate).render_overlay_pdf()
+
+
+def render_certificates(certificates, stream, processes=None):
+    """
+    Write certificates to stream as a single multi-page PDF
+
+    Field overlays are drawn in a process pool when more than one
+    process is allowed and the batch is at least
+    CERTIFICATE_BATCH_PROCESS_THRESHOLD certificates, web requests
+    should pass processes=1 rather than start a pool.
+    The base page is embedded once and shared by every page.
+    Related objects drawn on the certificate should be selected
+    beforehand, workers do not query the database.
+    """
+    certificates = list(certificates)
+    processes = processes or settings.CERTIFICATE_BATCH_PROCESSES
+
+    if processes > 1 and len(certificates) >= settings.CERTIFICATE_BATCH_PROCESS_THRESHOLD:
+        chunksize = max(len(certificates) // (processes * 4), 1)
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            overlays = list(pool.map(_render_overlay_pdf, certificates, chunksize=chunksize))
+    else:
+        overlays = [_render_overlay_pdf(certificate) for certificate in certificates]
+
+    with CertificatePreview._write_lock:
+        output = PdfFileWriter()
+        for overlay in overlays:
+            overlay_page = PdfFileReader(io.BytesIO(overlay)).getPage(0)
+            output.addPage(CertificatePreview.merge_with_base(overlay_page))
+        output.write(stream)
+    return len(overlays)
@@ -1,31 +1,39 @@
 import datetime
 import urllib
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import permission_required
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.core.exceptions import PermissionDenied
-from django.http import Http404, HttpResponse, JsonResponse
+from django.db import IntegrityError, transaction
+from django.http import (Http404, HttpResponse, JsonResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, redirect
 from django.template.response import TemplateResponse
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.utils.safestring import mark_safe
 from django.views import View
 from django.views.generic import DetailView, TemplateView
 from django.views.generic.edit import DeleteView, FormView, UpdateView
 from django_countries import countries
 from django_datatables_view.base_datatable_view import BaseDatatableView
-from djqscsv import render_to_csv_response
 
-from .filters import CertificateFilter
-from .forms import (CertificateRegisterForm, EditRequestForm,
+from .bulk import register_certificates
+from .filters import filter_panel
+from .forms import (BulkStatusUpdateForm, BulkVoidForm,
+                    CertificateRegisterForm, EditRequestForm,
                     EditRequestReviewForm, KpcAddressForm,
-                    LicenseeCertificateForm, StatusUpdateForm, VoidForm)
+                    LicenseeCertificateForm, StatisticsForm, StatusUpdateForm,
+                    VoidForm)
+from .history import buffered_history
 from .mail import notify_requester_of_completed_review, notify_reviewers
-from .models import (Certificate, CertificateConfig, EditRequest, KpcAddress,
-                     Licensee, Receipt)
-from .utils import CertificatePreview, _to_mdy, apply_certificate_search
+from .models import (Certificate, CertificateConfig, CertificateStatistic,
+                     EditRequest, KpcAddress, Licensee, Receipt)
+from .pagination import KeysetPaginationMixin
+from .utils import (CertificatePreview, _to_mdy, apply_certificate_search,
+                    render_certificates, stream_csv)
 
 User = get_user_model()
 
@@ -41,15 +49,17 @@ class ExportView(LoginRequiredMixin, View):
                "notes"]
 
     def _country_name_by_code(self, code):
-        return dict(countries)[code] if code else ''
+        return countries.name(code) if code else ''
+
+    filename = 'certificate_export.csv'
 
     def get(self, request):
-        """Return CSV of filtered certificates"""
+        """Stream CSV of filtered certificates"""
         qs = apply_certificate_search(
             request, request.user.profile.certificates())
         qs = qs.values(*self.columns)
 
-        export_kwargs = {'field_serializer_map': {
+        field_serializer_map = {
             'number': (lambda number: 'US' + str(number)),
             'status': Certificate.get_label_for_status,
             'last_modified': (lambda dt: dt.strftime("%m/%d/%Y %X %Z")),
@@ -60,8 +70,97 @@ class ExportView(LoginRequiredMixin, View):
             'date_of_delivery': _to_mdy,
             'date_voided': _to_mdy,
             'country_of_origin': self._country_name_by_code
-        }}
-        return render_to_csv_response(qs, **export_kwargs)
+        }
+        response = StreamingHttpResponse(stream_csv(qs, field_serializer_map), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename={self.filename};'
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+
+class CertificatePrintView(LoginRequiredMixin, View):
+    filename = 'certificates.pdf'
+    TOO_MANY = 'At most %s certificates may be printed at once, please narrow your search.'
+
+    def get(self, request):
+        """Return single PDF of filtered, prepared certificates"""
+        qs = apply_certificate_search(
+            request, request.user.profile.certificates())
+        qs = qs.filter(status__in=Certificate.PRINTABLE_STATUSES)
+        qs = qs.select_related('harmonized_code').order_by('number')
+
+        limit = settings.CERTIFICATE_BATCH_LIMIT
+        certificates = list(qs[:limit + 1])
+        if not certificates:
+            raise Http404
+        if len(certificates) > limit:
+            messages.warning(request, self.TOO_MANY % limit)
+            return redirect(reverse('certificates') + '?' + request.GET.urlencode())
+
+        response = HttpResponse(content_type='application/pdf')
+        response['Content-Disposition'] = f'attachment; filename={self.filename};'
+        render_certificates(certificates, response, processes=1)
+        return response
+
+
+class BulkCertificateView(LoginRequiredMixin, UserPassesTestMixin, FormView):
+    """Change certificates entered by number, or found by the certificate search, together"""
+
+    def test_func(self):
+        if not self.request.user.profile.can_edit_certs():
+            raise PermissionDenied
+        return True
+
+    def get_search(self):
+        """Certificates matching the search the user arrived from, if any"""
+        if not self.request.GET:
+            return None
+        return apply_certificate_search(self.request, self.request.user.profile.certificates())
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['certificates'] = self.request.user.profile.certificates()
+        kwargs['filtered'] = self.get_search()
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        search = self.get_search()
+        context['search_count'] = search.count() if search is not None else None
+        context['list_url'] = self.get_success_url()
+        return context
+
+    def get_success_url(self):
+        query = self.request.GET.urlencode() or Certificate.default_search_filters(self.request.user)
+        return reverse('certificates') + '?' + query
+
+
+class CertificateStatusUpdateView(BulkCertificateView):
+    """Mark many certificates Shipped or Delivered"""
+    form_class = BulkStatusUpdateForm
+    template_name = 'certificate/bulk-status.html'
+
+    def form_valid(self, form):
+        count = form.save(self.request.user)
+        if count is None:
+            form.add_error(None, form.CHANGED)
+            return self.form_invalid(form)
+        label = Certificate.get_label_for_status(form.cleaned_data['next_status'])
+        messages.success(self.request, form.SUCCESS_MSG % (count, label))
+        return redirect(self.get_success_url())
+
+
+class CertificateBulkVoidView(BulkCertificateView):
+    """Void many certificates, e.g. a lost book of blank certificates"""
+    form_class = BulkVoidForm
+    template_name = 'certificate/bulk-void.html'
+
+    def form_valid(self, form):
+        already_void = form.selected.filter(void=True).count()
+        count = form.save(self.request.user)
+        messages.success(self.request, form.SUCCESS_MSG % count)
+        if already_void:
+            messages.info(self.request, form.ALREADY_VOID % already_void)
+        return redirect(self.get_success_url())
 
 
 @permission_required('accounts.can_get_licensee_contacts', raise_exception=True)
@@ -107,10 +206,11 @@ class EditRequestView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
         return super().post(request, *args, **kwargs)
 
     def form_valid(self, form):
-        edit_request = form.save(reviewer=self.request.user)
+        with buffered_history():
+            edit_request = form.save(reviewer=self.request.user)
+            notify_requester_of_completed_review(self.request, edit_request)
         messages.success(self.request, self.SUCCESS %
                          self.get_object().get_status_display())
-        notify_requester_of_completed_review(self.request, edit_request)
         return redirect(self.get_success_url())
 
 
@@ -140,6 +240,8 @@ class CertificateRegisterView(LoginRequiredMixin, UserPassesTestMixin, FormView)
     form_class = CertificateRegisterForm
     success_url = reverse_lazy('cert-register')
 
+    CONFLICT = 'At least one of the requested certificates was registered while this form was being submitted.'
+
     @staticmethod
     def get_success_msg(count, receipt):
         success_msg = f'''Generated {count} new certificates.
@@ -154,14 +256,20 @@ class CertificateRegisterView(LoginRequiredMixin, UserPassesTestMixin, FormView)
         cert_kwargs = {'assignor': self.request.user, 'licensee': form.cleaned_data['licensee'],
                        'date_of_sale': form.cleaned_data['date_of_sale'],
                        'last_modified': datetime.datetime.now()}
-        certs = form.get_cert_list()
-
-        if certs:
-            Certificate.objects.bulk_create(Certificate(
-                number=i, **cert_kwargs) for i in certs)
-            receipt = form.save()
+        ranges = form.get_cert_ranges()
+
+        if ranges:
+            try:
+                with buffered_history():
+                    count = register_certificates(ranges, history_user=self.request.user,
+                                                  **cert_kwargs)
+                    # Saved last, so the receipt number is reserved just before commit
+                    receipt = form.save()
+            except IntegrityError:
+                form.add_error(None, self.CONFLICT)
+                return self.form_invalid(form)
             messages.success(
-                self.request, self.get_success_msg(len(certs), receipt))
+                self.request, self.get_success_msg(count, receipt))
         return super().form_valid(form)
 
 
@@ -170,15 +278,14 @@ class CertificateListView(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['filters'] = CertificateFilter(
-            self.request.GET, request=self.request, queryset=self.request.user.profile.certificates())
+        context['filter_panel'] = filter_panel(self.request)
         context['statuses'] = {status[0]: status[1]
                                for status in Certificate.STATUS_CHOICES}
         context['dt_columns'] = CertificateJson.columns
         return context
 
 
-class CertificateJson(LoginRequiredMixin, BaseDatatableView):
+class CertificateJson(LoginRequiredMixin, KeysetPaginationMixin, BaseDatatableView):
     model = Certificate
     columns = ["number", "status", "last_modified", "licensee__name",
                "aes", "consignee", "shipped_value",
@@ -207,6 +314,9 @@ class BaseCertificateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     slug_field = 'number'
     slug_url_kwarg = 'number'
 
+    def get_queryset(self):
+        return Certificate.objects.with_edit_state()
+
 
 class CertificateView(BaseCertificateView):
     REVIEW_MSG = "Please review the certificate data below."
@@ -296,8 +406,9 @@ class CertificateEditView(BaseCertificateView):
         if not form.has_changed():
             messages.warning(self.request, self.NO_CHANGE)
         else:
-            edit_request = form.save(contact=self.request.user)
-            notify_reviewers(self.request, edit_request)
+            with transaction.atomic():
+                edit_request = form.save(contact=self.request.user)
+                notify_reviewers(self.request, edit_request)
         return redirect(self.get_success_url())
 
 
@@ -365,6 +476,37 @@ class BaseAddressView(LoginRequiredMixin, UserPassesTestMixin):
         return accessible
 
 
+class KpcAddressJson(LoginRequiredMixin, UserPassesTestMixin, View):
+    """
+    A page of a licensee's address book for autocompletion
+
+    Entries are ordered by name, optionally narrowed to names beginning
+    with q, and continue after the name given as after.
+    """
+    raise_exception = True
+
+    def test_func(self):
+        licensee = get_object_or_404(Licensee, pk=self.kwargs['pk'])
+        return licensee.user_can_access(self.request.user)
+
+    def get(self, request, *args, **kwargs):
+        addresses = KpcAddress.objects.filter(licensee_id=self.kwargs['pk']).order_by('name')
+        prefix = request.GET.get('q', '').strip()
+        if prefix:
+            addresses = addresses.filter(name__istartswith=prefix)
+        after = request.GET.get('after')
+        if after:
+            addresses = addresses.filter(name__gt=after)
+
+        page_size = settings.ADDRESS_BOOK_PAGE_SIZE
+        page = list(addresses.values('id', 'name', 'address', 'country')[:page_size + 1])
+        more = len(page) > page_size
+        page = page[:page_size]
+        for address in page:
+            address['country'] = countries.name(address['country'])
+        return JsonResponse({'results': page, 'next': page[-1]['name'] if more else None})
+
+
 class KpcAddressCreate(BaseAddressView, FormView):
     form_class = KpcAddressForm
     template_name = 'kpc_address/create.html'
@@ -430,3 +572,37 @@ class ReceiptView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
         if self.request.user.is_superuser:
             return True
         raise PermissionDenied
+
+
+class StatisticsAccessMixin(LoginRequiredMixin, UserPassesTestMixin):
+    """Statistics span all licensees, limited to users who may view all certificates"""
+    raise_exception = True
+
+    def test_func(self):
+        return self.request.user.profile.can_access_all_certificates()
+
+
+class CertificateStatisticsJson(StatisticsAccessMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        form = StatisticsForm(request.GET)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+        return JsonResponse({'refreshed_at': CertificateStatistic.refreshed(),
+                             'results': form.statistics()})
+
+
+class CertificateStatisticsView(StatisticsAccessMixin, TemplateView):
+    template_name = 'statistics.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        form = StatisticsForm(self.request.GET or None)
+        if not form.is_bound:
+            form = StatisticsForm({'group_by': form.fields['group_by'].initial})
+        context['form'] = form
+        if form.is_valid():
+            context['group_by'] = form.cleaned_data['group_by']
+            context['statistics'] = form.statistics()
+        context['refreshed_at'] = CertificateStatistic.refreshed()
+        return context
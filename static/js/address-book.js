@@ -0,0 +1,39 @@
+// Load a licensee's address book on demand, narrowed by name as the user searches
+(function($) {
+    $(document).ready(function() {
+        $('select.address-book').each(function() {
+            var select = $(this);
+            var search = $('#' + select.attr('id') + '_search');
+            var more = $('#' + select.attr('id') + '_more');
+            var loadedFor = null;
+            var timer = null;
+
+            function load() {
+                var query = search.val().trim();
+                if (query === loadedFor) {
+                    return;
+                }
+                loadedFor = query;
+                $.getJSON(select.data('url'), {q: query}, function(data) {
+                    if (query !== loadedFor) {
+                        return;
+                    }
+                    select.find('option').not(':first').remove();
+                    $.each(data.results, function(i, address) {
+                        select.append($('<option>').val(address.id).text(address.name)
+                            .attr('data-address', address.address)
+                            .attr('data-country', address.country));
+                    });
+                    more.toggle(data.next !== null);
+                });
+            }
+
+            select.on('focus mousedown', load);
+            search.on('focus', load);
+            search.on('input', function() {
+                clearTimeout(timer);
+                timer = setTimeout(load, 250);
+            });
+        });
+    });
+})(window.jQuery);
@@ -13,6 +13,7 @@ from django.core.exceptions import ImproperlyConfigured
 import dj_database_url
 import os
 import sys
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -87,6 +88,27 @@ WSGI_APPLICATION = 'uskpa.wsgi.application'
 DATABASES = {}
 DATABASES['default'] = dj_database_url.config(conn_max_age=600)
 
+# CACHES
+# ------------------------------------------------------------------------------
+# 'config' holds the CertificateConfig and filter version stamps. The file backend is
+# shared by workers on a single host only, stamps expire after CONFIG_CACHE_TIMEOUT
+# seconds so that changes saved on another host (e.g. another dyno) are picked up
+CONFIG_CACHE_TIMEOUT = int(os.environ.get('CONFIG_CACHE_TIMEOUT', 60))
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'config': {
+        'BACKEND': os.environ.get('CONFIG_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('CONFIG_CACHE_LOCATION', os.path.join(tempfile.gettempdir(), 'uskpa-config-cache')),
+        'TIMEOUT': CONFIG_CACHE_TIMEOUT,
+    },
+}
+CERTIFICATE_CONFIG_VERSION_CACHE = 'config'
+# Seconds to keep certificate filter choices and panels in the default cache,
+# entries are also dropped whenever a licensee, HS code, port or the configuration is saved
+CERTIFICATE_FILTER_CACHE_TIMEOUT = int(os.environ.get('CERTIFICATE_FILTER_CACHE_TIMEOUT', 3600))
+
 # PASSWORDS
 # ------------------------------------------------------------------------------
 # https://docs.djangoproject.com/en/2.0/ref/settings/#password-hashers
@@ -183,6 +205,9 @@ DEFAULT_FROM_EMAIL = os.environ.get(
     default=CONTACT_US
 )
 
+# absolute URL of the site, for links in email sent outside of a request
+SITE_URL = os.environ.get('SITE_URL', 'http://localhost:8000')
+
 EMAIL_BACKEND = os.environ.get('DJANGO_EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
 EMAIL_SUBJECT_PREFIX = os.environ.get('DJANGO_EMAIL_SUBJECT_PREFIX', default='[LOCALHOST] ')
 
@@ -200,14 +225,42 @@ elif EMAIL_BACKEND.startswith("anymail"):
         raise ImproperlyConfigured(f'SENDGRID_API_KEY must be set when EMAIL_BACKEND={EMAIL_BACKEND}')
 
 
+# Queued email delivery, see the send_queued_email command
+# Messages sent per worker batch, over a single backend connection
+EMAIL_QUEUE_BATCH_SIZE = int(os.environ.get('EMAIL_QUEUE_BATCH_SIZE', 50))
+# Delivery attempts before a message is marked failed
+EMAIL_QUEUE_MAX_ATTEMPTS = int(os.environ.get('EMAIL_QUEUE_MAX_ATTEMPTS', 5))
+# Seconds before the first retry, doubling with each further attempt
+EMAIL_QUEUE_RETRY_DELAY = int(os.environ.get('EMAIL_QUEUE_RETRY_DELAY', 60))
+
 SHOW_CERT_PDF_ADDRESS_BOUNDARY = False
 KPC_BASE = os.path.join(BASE_DIR, 'kpc', 'resources', 'kpc_base.pdf')
 
+# Batch certificate printing
+# Maximum certificates rendered into a single PDF
+CERTIFICATE_BATCH_LIMIT = int(os.environ.get('CERTIFICATE_BATCH_LIMIT', 500))
+# Batches of at least this size render in a process pool of CERTIFICATE_BATCH_PROCESSES workers,
+# web requests always render in-process, raise only for management commands or workers
+CERTIFICATE_BATCH_PROCESS_THRESHOLD = int(os.environ.get('CERTIFICATE_BATCH_PROCESS_THRESHOLD', 50))
+CERTIFICATE_BATCH_PROCESSES = int(os.environ.get('CERTIFICATE_BATCH_PROCESSES', 1))
+
 # Last receipt number
 # Should only be modified upon initial release of the system
 # Sets starting value for Receipt.number field
 LAST_RECEIPT_NUMBER = 1300
 
+# Certificate listing
+# Seconds to reuse record counts and keyset page bookmarks
+DATATABLES_COUNT_CACHE_TIMEOUT = int(os.environ.get('DATATABLES_COUNT_CACHE_TIMEOUT', 60))
+# Unfiltered tables larger than this use the planner's row estimate in place of COUNT(*)
+DATATABLES_ESTIMATED_COUNT_THRESHOLD = int(os.environ.get('DATATABLES_ESTIMATED_COUNT_THRESHOLD', 100000))
+
+# Address book entries returned per autocomplete request
+ADDRESS_BOOK_PAGE_SIZE = int(os.environ.get('ADDRESS_BOOK_PAGE_SIZE', 20))
+
+# Rows fetched per round trip when streaming certificate CSV exports
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 2000))
+
 # LOGGING CONFIG
 DJANGO_LOG_LEVEL = os.getenv('DJANGO_LOG_LEVEL', 'ERROR' if IS_DEPLOYED else 'DEBUG')
 LOGGING = {
@@ -20,9 +20,15 @@ urlpatterns = [
     path('certificates/<int:number>', kpc_views.CertificateView.as_view(), name='cert-details'),
     path('certificates/', kpc_views.CertificateListView.as_view(), name='certificates'),
     path('certificates/export', kpc_views.ExportView.as_view(), name='export'),
+    path('certificates/print', kpc_views.CertificatePrintView.as_view(), name='print'),
+    path('certificates/status', kpc_views.CertificateStatusUpdateView.as_view(), name='bulk-status'),
+    path('certificates/void', kpc_views.CertificateBulkVoidView.as_view(), name='bulk-void'),
     path('certificates-data/', kpc_views.CertificateJson.as_view(), name='certificate-data'),
+    path('statistics/', kpc_views.CertificateStatisticsView.as_view(), name='statistics'),
+    path('statistics-data/', kpc_views.CertificateStatisticsJson.as_view(), name='statistics-data'),
     path('licensee/<int:pk>', kpc_views.LicenseeDetailView.as_view(), name='licensee'),
     path('licensee/<int:pk>/new_addressee', kpc_views.KpcAddressCreate.as_view(), name='new-addressee'),
+    path('licensee/<int:pk>/addresses', kpc_views.KpcAddressJson.as_view(), name='licensee-addresses'),
     path('addressee/<int:pk>', kpc_views.KpcAddressUpdate.as_view(), name='addressee'),
     path('addressee/<int:pk>/delete', kpc_views.KpcAddressDelete.as_view(), name='addressee-delete'),
     path('licensee-contacts/', kpc_views.licensee_contacts, name='licensee-contacts'),